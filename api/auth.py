@@ -1,3 +1,6 @@
+import asyncio
+import hashlib
+import time
 from collections.abc import Awaitable, Callable
 from functools import wraps
 from typing import Concatenate, ParamSpec, TypeVar
@@ -5,9 +8,12 @@ from typing import Concatenate, ParamSpec, TypeVar
 import jwt
 from sanic import Sanic
 from sanic.exceptions import Unauthorized
+from sanic.log import logger
 from sanic.request import Request
 from sanic.response import BaseHTTPResponse
 
+from api.metrics import span
+
 Params = ParamSpec('Params')
 ResponseType = TypeVar('ResponseType', bound=BaseHTTPResponse)
 
@@ -32,18 +38,101 @@ def protected(wrapped: Callable[Concatenate[Request, Params], Awaitable[Response
     return decorator(wrapped)
 
 
-def decode_token(token: str) -> dict:
-    signing_key = Sanic.get_app().ctx.jwks_client.get_signing_key_from_jwt(
-        token
-    )
-    return jwt.decode(
+# Signing keys of the JWKS endpoint which are fetched in a separate thread,
+# so that a slow response of the endpoint does not block the event loop
+class Keys(object):
+    # Minimum amount of seconds between two refreshes caused by unknown key ids
+    REFRESH_INTERVAL = 60
+
+    def __init__(self, client: jwt.PyJWKClient) -> None:
+        self.client = client
+        self.keys: dict[str, jwt.PyJWK] = {}
+        self.refreshed_at = 0.0
+        self.attempts = 0
+        self.lock = asyncio.Lock()
+
+    # Fetch the keys unless they were fetched within the given interval,
+    # calls waiting for a running attempt share its result (even if it failed)
+    async def refresh(self, interval: float = 0) -> None:
+        attempts = self.attempts
+        async with self.lock:
+            if (
+                self.attempts != attempts
+                or time.monotonic() - self.refreshed_at < interval
+            ):
+                return
+
+            try:
+                jwk_set = await asyncio.to_thread(
+                    self.client.get_jwk_set, refresh=True
+                )
+            except jwt.exceptions.PyJWKClientError as error:
+                logger.warning(f'Could not refresh the signing keys: {error}')
+                return
+            finally:
+                self.attempts += 1
+            self.keys = {
+                key.key_id: key
+                for key in jwk_set.keys
+                if key.key_id is not None
+            }
+            self.refreshed_at = time.monotonic()
+
+    async def get(self, token: str) -> jwt.PyJWK:
+        kid = jwt.get_unverified_header(token).get('kid')
+        if kid is None:
+            raise jwt.exceptions.InvalidTokenError(
+                'The token does not contain a key id'
+            )
+
+        # Fetch the keys again in case the key was rotated recently
+        if kid not in self.keys:
+            await self.refresh(self.REFRESH_INTERVAL)
+
+        if kid not in self.keys:
+            raise jwt.exceptions.InvalidTokenError(
+                f'Unable to find a signing key that matches {kid}'
+            )
+        return self.keys[kid]
+
+
+# Refresh the signing keys periodically in the background
+async def refresh_keys(app: Sanic) -> None:
+    while True:
+        await app.ctx.keys.refresh()
+        await asyncio.sleep(app.config.JWKS_REFRESH_INTERVAL)
+
+
+# Tokens are only identified by their hash to not keep them in memory
+def fingerprint(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def decode_token(token: str) -> dict:
+    app = Sanic.get_app()
+    key = fingerprint(token)
+
+    # Skip the verification of the signature if the token was verified recently
+    info = app.ctx.tokens.get(key)
+    if info is not None:
+        return info
+
+    signing_key = await app.ctx.keys.get(token)
+    info = jwt.decode(
         token,
         signing_key,
-        audience=Sanic.get_app().config.OPENSTREETMAP_OAUTH_CLIENT_ID,
+        audience=app.config.OPENSTREETMAP_OAUTH_CLIENT_ID,
         options={'verify_exp': False},
         algorithms=['RS256'],
     )
 
+    # Do not keep the token any longer than it is valid
+    ttl = None
+    if 'exp' in info:
+        ttl = info['exp'] - time.time()
+    app.ctx.tokens.set(key, info, ttl)
+    return info
+
 
 async def is_authenticated(request: Request) -> bool:
     token = request.token
@@ -52,7 +141,7 @@ async def is_authenticated(request: Request) -> bool:
 
     info = None
     try:
-        info = decode_token(token)
+        info = await decode_token(token)
     except jwt.exceptions.InvalidTokenError:
         return False
 
@@ -75,7 +164,8 @@ async def attach_uid(request: Request) -> None:
     # Validate the JWT and extract the user id (sub claim)
     info = None
     try:
-        info = decode_token(token)
+        with span('auth'):
+            info = await decode_token(token)
     except jwt.exceptions.InvalidTokenError:
         return
 
@@ -83,11 +173,18 @@ async def attach_uid(request: Request) -> None:
     if info is None or 'sub' not in info:
         return
 
-    # Check if the user exists (logged in before) and is currently using this token
+    # Check if the user exists (logged in before) and is currently using this token,
+    # the result is cached until the user logs in or out again (or the entry expires)
     uid = int(info['sub'])
-    user = await Sanic.get_app().ctx.db.users.find_one({'_id': uid})
-    if user is None or user['token'] != token:
-        return
+    sessions = Sanic.get_app().ctx.sessions
+    if sessions.get(uid) != fingerprint(token):
+        # A logout while reading the user invalidates the session, which must not be cached afterwards
+        created = time.time()
+        with span('session'):
+            user = await Sanic.get_app().ctx.db.users.find_one({'_id': uid})
+        if user is None or user['token'] != token:
+            return
+        sessions.set(uid, fingerprint(token), created=created)
 
     # Finally attach the uid to the request context
     request.ctx.uid = uid
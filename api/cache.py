@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from collections.abc import Callable, MutableSequence
+from typing import Generic, TypeVar
+
+Key = TypeVar('Key')
+Value = TypeVar('Value')
+
+
+# A size-bounded in-process cache which evicts the least recently used entries
+# and expires entries after a given time to live (in seconds).
+# Entries can optionally be invalidated in all workers by using an array shared between them,
+# which stores the time of the last invalidation of each key (keys must be integers in this case,
+# since they are mapped to a fixed number of slots and collisions only cause unnecessary reloads)
+class Cache(Generic[Key, Value]):
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        invalidations: MutableSequence[float] | None = None,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.invalidations = invalidations
+        self.entries: OrderedDict[Key, tuple[float, float, Value]] = (
+            OrderedDict()
+        )
+
+    def get(self, key: Key) -> Value | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, created, value = entry
+        if expires <= time.monotonic() or self.invalidated(key, created):
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    # Store a value, optionally with a shorter time to live than the default
+    # and the time when the value was read (to not miss invalidations while reading it)
+    def set(
+        self,
+        key: Key,
+        value: Value,
+        ttl: float | None = None,
+        created: float | None = None,
+    ) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        created = time.time() if created is None else created
+        self.entries[key] = (time.monotonic() + ttl, created, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    # Remove an entry, which is also invalidated in all other workers
+    def delete(self, key: Key) -> None:
+        self.entries.pop(key, None)
+        if self.invalidations is not None:
+            self.invalidations[self.slot(key)] = time.time()
+
+    # Modify a cached value instead of reading it again after it was changed
+    def update(self, key: Key, function: Callable[[Value], Value]) -> None:
+        value = self.get(key)
+        self.delete(key)
+        if value is not None:
+            self.set(key, function(value))
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def invalidated(self, key: Key, created: float) -> bool:
+        if self.invalidations is None:
+            return False
+        return self.invalidations[self.slot(key)] >= created
+
+    def slot(self, key: Key) -> int:
+        if self.invalidations is None:
+            raise ValueError('The cache is not shared between workers')
+        return hash(key) % len(self.invalidations)
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,89 @@
+from typing import Any
+
+from pymongo.asynchronous.database import AsyncDatabase
+
+from api import tiles
+
+STATUSES = ['open', 'closed']
+
+
+# Check whether the clusters of a search can be combined from the amount of notes of each tile,
+# which are counted in advance by scripts/tiles.py. The counts only distinguish the status of the notes,
+# so apart from the status only a bounding box and excluded notes (e.g. the blocklist) are supported
+def supported(filter: dict[str, Any]) -> bool:
+    for key, value in filter.items():
+        if key == 'status':
+            continue
+        if key == 'coordinates' and '$box' in value.get('$geoWithin', {}):
+            continue
+        if key == '_id' and list(value) == ['$nin']:
+            continue
+        return False
+    return True
+
+
+# Get the clusters of the tiles of a zoom level (in the same format as api.tiles.grid()),
+# the clusters at the border of a bounding box contain all notes of their tile
+async def clusters(
+    db: AsyncDatabase, filter: dict[str, Any], zoom: int, limit: int
+) -> list[dict[str, Any]]:
+    condition: dict[str, Any] = {'z': zoom}
+    if 'coordinates' in filter:
+        (west, south), (east, north) = filter['coordinates']['$geoWithin'][
+            '$box'
+        ]
+        x1, y1 = tiles.tile(west, north, zoom)
+        x2, y2 = tiles.tile(east, south, zoom)
+        condition['x'] = {'$gte': x1, '$lte': x2}
+        condition['y'] = {'$gte': y1, '$lte': y2}
+    statuses = [filter['status']] if 'status' in filter else STATUSES
+
+    cells = {}
+    async for document in db.clusters.find(condition):
+        cells[document['x'], document['y']] = {
+            status: dict(document[status]) for status in statuses
+        }
+
+    # Excluded notes are removed from the counts of their tiles
+    excluded = filter.get('_id', {}).get('$nin', [])
+    if len(excluded) > 0:
+        async for note in db.notes.find(
+            {'_id': {'$in': excluded}}, {'coordinates': True, 'status': True}
+        ):
+            longitude, latitude = note['coordinates']
+            cell = cells.get(tiles.tile(longitude, latitude, zoom))
+            if cell is None or note['status'] not in cell:
+                continue
+            counts = cell[note['status']]
+            counts['count'] -= 1
+            counts['longitude'] -= longitude
+            counts['latitude'] -= latitude
+
+    result = []
+    for (x, y), cell in cells.items():
+        count = sum(counts['count'] for counts in cell.values())
+        if count <= 0:
+            continue
+        result.append(
+            {
+                'count': count,
+                'open': cell['open']['count'] if 'open' in cell else 0,
+                'closed': cell['closed']['count'] if 'closed' in cell else 0,
+                'tile': [zoom, x, y],
+                'coordinates': [
+                    sum(counts['longitude'] for counts in cell.values())
+                    / count,
+                    sum(counts['latitude'] for counts in cell.values())
+                    / count,
+                ],
+            }
+        )
+    # Keep the largest clusters if there are too many of them
+    result.sort(
+        key=lambda cluster: (
+            -cluster['count'],
+            cluster['tile'][1],
+            cluster['tile'][2],
+        )
+    )
+    return result[:limit]
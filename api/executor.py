@@ -0,0 +1,26 @@
+import asyncio
+import contextvars
+import functools
+from collections.abc import Callable
+from typing import Any, TypeVar
+
+from sanic import Sanic
+
+Result = TypeVar('Result')
+
+
+# Run a function which needs a lot of CPU time in the threads of the worker (see EXECUTOR_WORKERS),
+# so that the event loop can still handle other requests in the meantime.
+# This only helps for functions written in Python, since functions written in C
+# (e.g. of orjson) keep the interpreter lock until they are finished.
+# The context is kept to still measure the stages of the request (see api.metrics)
+async def offload(
+    function: Callable[..., Result],
+    *args: Any,  # noqa: ANN401
+    **kwargs: Any,  # noqa: ANN401
+) -> Result:
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        Sanic.get_app().ctx.executor,
+        functools.partial(context.run, function, *args, **kwargs),
+    )
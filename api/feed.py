@@ -0,0 +1,109 @@
+import asyncio
+
+from pymongo import CursorType
+from pymongo.errors import OperationFailure
+from sanic import Sanic
+from sanic.log import logger
+
+from api.matcher import Predicate
+
+# Error code of the database if change streams are not supported (i.e. without a replica set)
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+
+# A client of the live feed, which receives all changed notes matching its filter
+class Subscription(object):
+    def __init__(self, predicate: Predicate, size: int) -> None:
+        self.predicate = predicate
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=size)
+        # Set if the client did not receive the notes fast enough
+        self.overflowed = False
+
+
+# Distributes the changed notes of the database to all clients of a worker,
+# so that the changes are only read once instead of being searched by every client
+class Feed(object):
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.subscriptions: set[Subscription] = set()
+
+    def subscribe(self, predicate: Predicate) -> Subscription:
+        subscription = Subscription(predicate, self.size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+
+    def publish(self, note: dict) -> None:
+        note.pop('fingerprint', None)
+        for subscription in list(self.subscriptions):
+            if subscription.overflowed or not subscription.predicate(note):
+                continue
+            try:
+                subscription.queue.put_nowait(note)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+
+
+# Read all changes of the notes and publish them to the feed, which uses a change stream if possible
+# and otherwise the collection of changes written by the update script
+async def watch(app: Sanic) -> None:
+    while True:
+        try:
+            await stream(app)
+        except OperationFailure as error:
+            if error.code != CHANGE_STREAMS_UNSUPPORTED:
+                logger.warning(f'Could not watch the notes: {error}')
+                await asyncio.sleep(app.config.FEED_RETRY_INTERVAL)
+                continue
+            try:
+                await tail(app)
+            except Exception as error:
+                logger.warning(f'Could not read the changes: {error}')
+        except Exception as error:
+            # The feed needs to be continued after any error, since it would stop silently otherwise
+            logger.warning(f'Could not watch the notes: {error}')
+        await asyncio.sleep(app.config.FEED_RETRY_INTERVAL)
+
+
+async def stream(app: Sanic) -> None:
+    async with await app.ctx.db.notes.watch(
+        [
+            {
+                '$match': {
+                    'operationType': {'$in': ['insert', 'update', 'replace']}
+                }
+            }
+        ],
+        full_document='updateLookup',
+    ) as changes:
+        async for change in changes:
+            # The note might have been deleted before it was looked up
+            if change.get('fullDocument') is not None:
+                app.ctx.feed.publish(change['fullDocument'])
+
+
+# Follow the capped collection of changes, starting after the last existing change.
+# The cursor dies if the collection is empty or the last read change was overwritten,
+# in this case it is opened again after the last published change
+async def tail(app: Sanic) -> None:
+    last = await app.ctx.db.changes.find_one(sort=[('$natural', -1)])
+    last_id = None if last is None else last['_id']
+    while True:
+        query = {} if last_id is None else {'_id': {'$gt': last_id}}
+        cursor = app.ctx.db.changes.find(
+            query, cursor_type=CursorType.TAILABLE_AWAIT
+        )
+        try:
+            while cursor.alive:
+                try:
+                    change = await cursor.next()
+                except StopAsyncIteration:
+                    # No new changes were written while waiting for them
+                    continue
+                last_id = change['_id']
+                app.ctx.feed.publish(change['note'])
+        finally:
+            await cursor.close()
+        await asyncio.sleep(app.config.FEED_RETRY_INTERVAL)
@@ -0,0 +1,10 @@
+from sanic.request import Request
+
+
+# Check whether the client already knows the current version of a response (by its ETag)
+def matches(request: Request, etag: str) -> bool:
+    tags = [
+        tag.strip().removeprefix('W/')
+        for tag in request.headers.get('If-None-Match', '').split(',')
+    ]
+    return etag.removeprefix('W/') in tags or '*' in tags
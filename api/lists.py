@@ -0,0 +1,46 @@
+import time
+
+from sanic import Sanic
+
+from api.metrics import span
+
+
+# Get the ids of all notes on the personal blocklist of a user,
+# which are cached until the blocklist is modified by the user
+async def blocklist(uid: int) -> list[int]:
+    app = Sanic.get_app()
+    ids = app.ctx.blocklists.get(uid)
+    if ids is None:
+        created = time.time()
+        with span('blocklist'):
+            ids = await app.ctx.db.blocklist.distinct('note', {'user': uid})
+        app.ctx.blocklists.set(uid, ids, created=created)
+    return ids
+
+
+# Get the entries of the personal watchlist of a user by the id of the note,
+# which are cached until the watchlist is modified by the user
+async def watchlist(uid: int) -> dict[int, dict]:
+    app = Sanic.get_app()
+    entries = app.ctx.watchlists.get(uid)
+    if entries is None:
+        created = time.time()
+        with span('watchlist'):
+            cursor = app.ctx.db.watchlist.find(
+                {
+                    'user': uid,
+                },
+                {
+                    '_id': False,
+                    'note': True,
+                    'comment': True,
+                    'created_at': True,
+                    'updated_at': True,
+                },
+            )
+            entries = {}
+            async for document in cursor:
+                entries[document.pop('note')] = document
+            await cursor.close()
+        app.ctx.watchlists.set(uid, entries, created=created)
+    return entries
@@ -0,0 +1,280 @@
+import datetime
+import re
+import unicodedata
+from collections.abc import Callable
+from typing import Any
+
+from api.query import Text
+
+Predicate = Callable[[dict], bool]
+# A test of all values of a path in a note (see getter())
+Test = Callable[[list[Any]], bool]
+
+
+# Create a function which checks whether a single note matches a filter (see api.query.Filter),
+# so that notes can be filtered without querying the database.
+# The filter is only analyzed once, so that the function is fast enough to be called for a lot of notes.
+# Only the operators used by the filters are supported, other operators raise a ValueError
+def predicate(filter: dict[str, Any]) -> Predicate:
+    return every([condition(key, value) for key, value in filter.items()])
+
+
+def every(predicates: list[Predicate]) -> Predicate:
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda note: all(test(note) for test in predicates)
+
+
+def condition(key: str, value: Any) -> Predicate:  # noqa: ANN401
+    if key == '$and':
+        return every([predicate(part) for part in value])
+    if key == '$or':
+        predicates = [predicate(part) for part in value]
+        return lambda note: any(test(note) for test in predicates)
+    if key == '$text':
+        return text(value['$search'])
+    if key.startswith('$'):
+        raise ValueError(f'The operator {key} is not supported')
+
+    # A value without any operators needs to be equal
+    if not isinstance(value, dict) or not any(
+        operator.startswith('$') for operator in value
+    ):
+        value = {'$eq': value}
+
+    tests = []
+    for operator, operand in value.items():
+        if operator == '$options':
+            continue
+        if operator == '$regex':
+            operator, operand = '$eq', pattern(operand, value)
+        if operator not in OPERATORS:
+            raise ValueError(f'The operator {operator} is not supported')
+        tests.append(OPERATORS[operator](normalize(operand)))
+
+    get = getter(key)
+    if len(tests) == 1:
+        test = tests[0]
+        return lambda note: test(get(note))
+
+    def check(note: dict) -> bool:
+        values = get(note)
+        return all(test(values) for test in tests)
+
+    return check
+
+
+# Create a function which finds all values of a (dotted) path in a note, where the values of arrays are contained separately
+# (e.g. comments.user returns the users of all comments, while comments.0.user only returns the first one)
+def getter(path: str) -> Callable[[dict], list[Any]]:
+    parts = path.split('.')
+    # Most fields of the filters are not nested and can be read directly
+    if len(parts) == 1:
+        return lambda note: [note[path]] if path in note else []
+
+    def get(note: dict) -> list[Any]:
+        values: list[Any] = [note]
+        for part in parts:
+            found = []
+            for value in values:
+                if isinstance(value, list) and part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                elif isinstance(value, list):
+                    found.extend(
+                        element[part]
+                        for element in value
+                        if isinstance(element, dict) and part in element
+                    )
+                elif isinstance(value, dict) and part in value:
+                    found.append(value[part])
+            values = found
+        return values
+
+    return get
+
+
+# Dates of notes are naive (but in UTC), so dates of filters need to be naive as well to be comparable
+def normalize(value: Any) -> Any:  # noqa: ANN401
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if isinstance(value, list):
+        return [normalize(element) for element in value]
+    return value
+
+
+def pattern(regex: str | re.Pattern, value: dict[str, Any]) -> re.Pattern:
+    if isinstance(regex, re.Pattern):
+        return regex
+    flags = re.IGNORECASE if 'i' in value.get('$options', '') else 0
+    try:
+        return re.compile(regex, flags)
+    except re.error as error:
+        raise ValueError(f'The regular expression is invalid: {error}')
+
+
+# Check whether any value is equal to one of the operands or matches one of the regular expressions,
+# a missing value is treated like null
+def member(operands: list[Any]) -> Test:
+    patterns = [x for x in operands if isinstance(x, re.Pattern)]
+    literals = [x for x in operands if not isinstance(x, re.Pattern)]
+    missing = None in literals
+
+    if len(patterns) == 0:
+        return lambda values: (
+            any(value in literals for value in values)
+            if len(values) > 0
+            else missing
+        )
+
+    def test(values: list[Any]) -> bool:
+        if len(values) == 0:
+            return missing
+        return any(
+            value in literals
+            or (
+                isinstance(value, str)
+                and any(p.search(value) for p in patterns)
+            )
+            for value in values
+        )
+
+    return test
+
+
+def everything(operands: list[Any]) -> Test:
+    tests = [member([operand]) for operand in operands]
+    return lambda values: all(test(values) for test in tests)
+
+
+def negate(test: Test) -> Test:
+    return lambda values: not test(values)
+
+
+# Compare values which might be of different types (e.g. a date and a number),
+# which never matches (like in the database)
+def comparison(compare: Callable[[Any, Any], bool]) -> Callable[[Any], Test]:
+    def create(operand: Any) -> Test:  # noqa: ANN401
+        def test(values: list[Any]) -> bool:
+            for value in values:
+                try:
+                    if compare(value, operand):
+                        return True
+                except TypeError:
+                    pass
+            return False
+
+        return test
+
+    return create
+
+
+# Check whether the coordinates of a note are contained in a bounding box or a (multi)polygon,
+# the array of coordinates is the only array which is not split into its values
+def within(operand: dict[str, Any]) -> Test:
+    if '$box' in operand:
+        (x1, y1), (x2, y2) = operand['$box']
+
+        def contains(longitude: float, latitude: float) -> bool:
+            return x1 <= longitude <= x2 and y1 <= latitude <= y2
+
+    elif '$geometry' in operand and operand['$geometry']['type'] in (
+        'Polygon',
+        'MultiPolygon',
+    ):
+        geometry = operand['$geometry']
+        polygons = (
+            [geometry['coordinates']]
+            if geometry['type'] == 'Polygon'
+            else geometry['coordinates']
+        )
+
+        def contains(longitude: float, latitude: float) -> bool:
+            return any(
+                inside(longitude, latitude, polygon) for polygon in polygons
+            )
+
+    else:
+        raise ValueError('Only bounding boxes and polygons are supported')
+
+    return lambda values: any(
+        isinstance(value, list) and len(value) == 2 and contains(*value)
+        for value in values
+    )
+
+
+# A position is inside of a polygon if it is inside of the outer ring, but not inside of one of the holes.
+# The edges are treated as straight lines instead of geodesics (like in the database),
+# which only makes a difference for positions very close to long edges
+def inside(
+    longitude: float, latitude: float, rings: list[list[list[float]]]
+) -> bool:
+    if len(rings) == 0 or not crosses(longitude, latitude, rings[0]):
+        return False
+    return not any(crosses(longitude, latitude, ring) for ring in rings[1:])
+
+
+# Count whether a ray starting at the position crosses the edges of a ring an odd number of times
+def crosses(
+    longitude: float, latitude: float, ring: list[list[float]]
+) -> bool:
+    result = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 > latitude) != (y2 > latitude) and longitude < (x2 - x1) * (
+            latitude - y1
+        ) / (y2 - y1) + x1:
+            result = not result
+    return result
+
+
+# Check whether the comments of a note match a search of the text index (without stemming, since no language is used):
+# terms are case and diacritic insensitive, if there are phrases all of them need to be contained,
+# otherwise at least one of the words, and none of the excluded words may be contained
+def text(search: str) -> Predicate:
+    query = Text(search)
+    phrases = [fold(phrase) for phrase in query.phrases]
+    words = {term for word in query.words for term in terms(word)}
+    excluded = {term for word in query.excluded for term in terms(word)}
+    get = getter('comments.text')
+
+    def test(note: dict) -> bool:
+        content = [x for x in get(note) if isinstance(x, str)]
+        found = {term for x in content for term in terms(x)}
+        content = [fold(x) for x in content]
+        if not found.isdisjoint(excluded):
+            return False
+        if len(phrases) > 0:
+            return all(any(p in x for x in content) for p in phrases)
+        return not found.isdisjoint(words)
+
+    return test
+
+
+# Split a text into the terms of the text index, which are separated by whitespace and punctuation (including underscores)
+def terms(value: str) -> list[str]:
+    return re.findall(r'[^\W_]+', fold(value))
+
+
+# The text index only uses simple case folding (e.g. ß is not folded to ss) and ignores diacritics
+def fold(value: str) -> str:
+    return ''.join(
+        character
+        for character in unicodedata.normalize('NFKD', value.lower())
+        if not unicodedata.combining(character)
+    )
+
+
+# Create the test for the values of a path from the operand of an operator
+OPERATORS: dict[str, Callable[[Any], Test]] = {
+    '$eq': lambda operand: member([operand]),
+    '$ne': lambda operand: negate(member([operand])),
+    '$in': member,
+    '$nin': lambda operand: negate(member(operand)),
+    '$all': everything,
+    '$exists': lambda operand: lambda values: (len(values) > 0) == operand,
+    '$gt': comparison(lambda a, b: a > b),
+    '$gte': comparison(lambda a, b: a >= b),
+    '$lt': comparison(lambda a, b: a < b),
+    '$lte': comparison(lambda a, b: a <= b),
+    '$geoWithin': within,
+}
@@ -0,0 +1,181 @@
+import time
+from collections.abc import Iterator, MutableSequence
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+from sanic import Sanic
+from sanic.request import Request
+from sanic.response import BaseHTTPResponse
+
+# Stages of a request whose duration is measured
+STAGES = (
+    # Verifying the token and looking up the session of the user
+    'auth',
+    'session',
+    # Reading the personal lists of the user
+    'blocklist',
+    'watchlist',
+    # Parsing the parameters (and the expressions of users in particular)
+    'parse',
+    'users',
+    # Starting the aggregation, reading its results and serializing them
+    'aggregate',
+    'iterate',
+    'serialize',
+    # The whole request until the response is sent (or starts streaming)
+    'total',
+)
+# Upper bounds (in seconds) of the buckets of the histograms
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Durations of the stages of the current request (by their name),
+# which is None outside of requests so that measurements are simply discarded
+timings: ContextVar[dict[str, float] | None] = ContextVar(
+    'timings', default=None
+)
+
+
+# Measure the duration of a stage of the current request,
+# the durations of a stage which is passed multiple times are summed up
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name: str, duration: float) -> None:
+    current = timings.get()
+    if current is not None:
+        current[name] = current.get(name, 0.0) + duration
+
+
+# Histograms of the durations of each stage, which can be stored in an array shared between
+# all workers, so that every worker reports the measurements of all workers.
+# Each stage occupies one slot per bucket (counting the durations up to the bound of the bucket),
+# one slot for the sum of all durations and one slot for the amount of durations
+class Histograms(object):
+    SLOTS = len(BUCKETS) + 2
+
+    def __init__(self, values: MutableSequence[float] | None = None) -> None:
+        self.values = (
+            values
+            if values is not None
+            else [0.0] * (len(STAGES) * self.SLOTS)
+        )
+
+    def observe(self, durations: dict[str, float]) -> None:
+        with lock(self.values):
+            for name, duration in durations.items():
+                if name not in STAGES:
+                    continue
+                offset = STAGES.index(name) * self.SLOTS
+                for i, bound in enumerate(BUCKETS):
+                    if duration <= bound:
+                        self.values[offset + i] += 1
+                self.values[offset + len(BUCKETS)] += duration
+                self.values[offset + len(BUCKETS) + 1] += 1
+
+    # Format the histograms in the text format of Prometheus
+    def export(self) -> str:
+        name = 'notesreview_stage_duration_seconds'
+        lines = [
+            f'# HELP {name} Duration of the stages of requests',
+            f'# TYPE {name} histogram',
+        ]
+        with lock(self.values):
+            values = list(self.values)
+        for i, stage in enumerate(STAGES):
+            offset = i * self.SLOTS
+            for j, bound in enumerate(BUCKETS):
+                lines.append(
+                    f'{name}_bucket{{stage="{stage}",le="{bound}"}} {values[offset + j]:.0f}'
+                )
+            count = values[offset + len(BUCKETS) + 1]
+            lines.extend(
+                [
+                    f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count:.0f}',
+                    f'{name}_sum{{stage="{stage}"}} {values[offset + len(BUCKETS)]}',
+                    f'{name}_count{{stage="{stage}"}} {count:.0f}',
+                ]
+            )
+        return '\n'.join(lines) + '\n'
+
+
+# Arrays shared between processes provide a lock, local lists do not need one
+@contextmanager
+def lock(values: Any) -> Iterator[None]:  # noqa: ANN401
+    if hasattr(values, 'get_lock'):
+        with values.get_lock():
+            yield
+    else:
+        yield
+
+
+# Format the durations of a request for the Server-Timing header (in milliseconds)
+def header(durations: dict[str, float]) -> str:
+    return ', '.join(
+        f'{name};dur={duration * 1000:.1f}'
+        for name, duration in durations.items()
+    )
+
+
+# Collect the stages of the query plan which was chosen by the database (e.g. IXSCAN, FETCH)
+# and the indices it uses, which is enough to see why a query was slow
+def summarize(plan: Any) -> dict[str, list[str]]:  # noqa: ANN401
+    stages: list[str] = []
+    indices: list[str] = []
+
+    def walk(value: Any, winning: bool) -> None:  # noqa: ANN401
+        if isinstance(value, dict):
+            for key, element in value.items():
+                # Plans which were not chosen are not relevant
+                if key == 'rejectedPlans':
+                    continue
+                if winning and key == 'stage' and isinstance(element, str):
+                    stages.append(element)
+                elif winning and key == 'indexName':
+                    indices.append(str(element))
+                walk(element, winning or key == 'winningPlan')
+        elif isinstance(value, list):
+            for element in value:
+                walk(element, winning)
+
+    walk(plan, False)
+    return {'stages': stages, 'indices': sorted(set(indices))}
+
+
+# Start measuring the stages of a request
+async def measure(request: Request) -> None:
+    request.ctx.started = time.perf_counter()
+    request.ctx.timings = {}
+    timings.set(request.ctx.timings)
+
+
+# Add the durations of the stages to the histograms and send them to the client,
+# so that the duration of each stage can also be seen in the developer tools of browsers
+async def report(request: Request, response: BaseHTTPResponse) -> None:
+    durations = getattr(request.ctx, 'timings', None)
+    if durations is None:
+        return
+    durations['total'] = time.perf_counter() - request.ctx.started
+    Sanic.get_app().ctx.histograms.observe(durations)
+    response.headers['Server-Timing'] = header(durations)
@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class Cluster:
+    # Zoom level, x and y of the tile containing the notes
+    tile: tuple[int, int, int]
+    # Center of all notes in the tile
+    coordinates: tuple[float, float]
+    count: int
+    open: int
+    closed: int
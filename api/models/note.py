@@ -11,3 +11,9 @@ class Note:
     status: str
     updated_at: datetime.datetime
     comments: list[Comment]
+    # Derived from the comments
+    created_at: datetime.datetime
+    comment_count: int
+    is_anonymous: bool
+    last_action: str
+    last_user: str | None
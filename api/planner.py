@@ -0,0 +1,104 @@
+from collections.abc import Iterator
+from typing import Any
+
+# Maximum amount of different amounts of comments in a range which is still considered selective
+NARROW_RANGE = 3
+
+
+# Classify the shape of a search by the condition which is likely the most selective one.
+# MongoDB often chooses a poor plan on its own, e.g. walking the index used for sorting
+# for a small polygon instead of using the geospatial index
+def classify(
+    sort: tuple[str | None, int], filter: dict[str, Any], area: float
+) -> str:
+    # The text index is always used for a text search, no other index can be chosen
+    if '$text' in filter:
+        return 'text'
+
+    # A fixed set of notes (e.g. the watchlist)
+    if '$in' in filter.get('_id', {}):
+        return 'ids'
+
+    if len(filter.get('comments.0.user', {}).get('$in', [])) > 0:
+        return 'author'
+    if len(filter.get('comments.user', {}).get('$all', [])) > 0:
+        return 'user'
+
+    # Only GeoJSON geometries can be answered by the 2dsphere index,
+    # bounding boxes ($box) use flat geometry which requires a 2d index
+    if '$geometry' in filter.get('coordinates', {}).get('$geoWithin', {}):
+        bounds = extent(filter['coordinates']['$geoWithin'])
+        if bounds is not None:
+            x1, y1, x2, y2 = bounds
+            if (x2 - x1) * (y2 - y1) <= area:
+                return 'geo'
+
+    # An exact amount or a narrow range of comments (e.g. uncommented notes),
+    # other ranges (e.g. all commented notes) match most notes and are faster to check while walking the index used for sorting
+    if 'comment_count' in filter and narrow(filter['comment_count']):
+        return 'comment_count'
+
+    # Otherwise walk the index used for sorting to avoid sorting in memory,
+    # which also contains the status if the notes are filtered by it
+    if sort[0] in ['updated_at', 'created_at']:
+        name = sort[0]
+        if filter.get('status') == 'open':
+            return f'open_{name}'
+        if 'status' in filter:
+            return f'status_{name}'
+        return name
+    return 'none'
+
+
+# Check whether a condition of the amount of comments is an exact amount or a range with an upper limit,
+# which contains at most a few different amounts
+def narrow(condition: int | dict[str, int]) -> bool:
+    if not isinstance(condition, dict):
+        return True
+    if '$lte' not in condition:
+        return False
+    return condition['$lte'] - condition.get('$gte', 0) + 1 <= NARROW_RANGE
+
+
+# Choose the index for the shape of a search from the configured candidates,
+# the first one which exists is used (e.g. the optional partial indices or the ones created by scripts/indices.py)
+def plan(
+    sort: tuple[str | None, int],
+    filter: dict[str, Any],
+    hints: dict[str, list[str]],
+    area: float,
+    indices: set[str],
+) -> tuple[str, str | None]:
+    shape = classify(sort, filter, area)
+    hint = next(
+        (name for name in hints.get(shape, []) if name in indices), None
+    )
+    return shape, hint
+
+
+# Calculate the bounding box (min. longitude, min. latitude, max. longitude, max. latitude) of a geospatial condition
+def extent(
+    condition: dict[str, Any],
+) -> tuple[float, float, float, float] | None:
+    if '$box' in condition:
+        (x1, y1), (x2, y2) = condition['$box']
+        return x1, y1, x2, y2
+
+    if '$geometry' in condition:
+        points = list(positions(condition['$geometry']['coordinates']))
+        if len(points) == 0:
+            return None
+        longitudes = [point[0] for point in points]
+        latitudes = [point[1] for point in points]
+        return min(longitudes), min(latitudes), max(longitudes), max(latitudes)
+
+    return None
+
+
+# Iterate over all positions of (nested) GeoJSON coordinates
+def positions(coordinates: list) -> Iterator[list[float]]:
+    if len(coordinates) > 0 and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for coordinate in coordinates:
+        yield from positions(coordinate)
@@ -1,4 +1,7 @@
-import os
+import base64
+import binascii
+import datetime
+import functools
 import re
 from typing import Any, Self
 
@@ -6,6 +9,8 @@ import dateutil.parser
 import lark
 import orjson
 
+from api.metrics import span
+
 
 class Sort(object):
     def build(self) -> tuple[str | None, int]:
@@ -15,7 +20,7 @@ class Sort(object):
         if by is None:
             by = default
 
-        allowed = ['none', 'updated_at', 'created_at']
+        allowed = ['none', 'updated_at', 'created_at', 'relevance']
         if by not in allowed:
             raise ValueError(f'Sort must be one of {allowed}')
 
@@ -24,7 +29,10 @@ class Sort(object):
         elif by == 'updated_at':
             self._by = 'updated_at'
         elif by == 'created_at':
-            self._by = 'comments.0.date'
+            self._by = 'created_at'
+        elif by == 'relevance':
+            # Sorting by the score of a text search, the order is always descending
+            self._by = 'relevance'
         return self
 
     def order(self, order: str | None, default: str) -> Self:
@@ -61,15 +69,52 @@ class Filter(object):
             # Allow searching for the query string in all comments, not just the first ones of each note
             if scope not in [None, 'all', 'first']:
                 raise ValueError('Scope must be one of [all, first]')
-            scope = 'comments.text' if scope == 'all' else 'comments.0.text'
-            self.filter[scope] = {
-                '$regex': (
-                    query.removeprefix('regex:')
-                    if query.startswith('regex:')
-                    else re.escape(query)
-                ),
-                '$options': 'i',
-            }
+            field = 'comments.text' if scope == 'all' else 'comments.0.text'
+
+            # Regular expressions can not use the text index
+            # and are matched against all notes, which is a lot slower
+            if query.startswith('regex:'):
+                self.filter[field] = {
+                    '$regex': query.removeprefix('regex:'),
+                    '$options': 'i',
+                }
+                return self
+
+            text = Text(query)
+            self.filter['$text'] = {'$search': text.search()}
+            # The text index contains all comments, so the results need to be narrowed down
+            # to the notes which contain the phrases (or at least one of the words) in the first comment
+            if field == 'comments.0.text':
+                self.filter[field] = text.first()
+        return self
+
+    def watchlist(self, mode: str, watchlist: dict[int, dict] | None) -> Self:
+        if watchlist is not None and mode in ['hide', 'only']:
+            ids = self.filter.get('_id', {})
+            if mode == 'hide' and len(watchlist) > 0:
+                # Do not modify the list of excluded notes, it might be cached
+                ids['$nin'] = [*ids.get('$nin', []), *watchlist.keys()]
+            if mode == 'only':
+                ids['$in'] = list(watchlist.keys())
+            self.filter['_id'] = ids
+        return self
+
+    def cursor(self, input: str | None) -> Self:
+        if input is not None:
+            key, order = self.sort
+            if key in [None, 'relevance']:
+                raise ValueError(
+                    'A cursor can only be used with results sorted by date'
+                )
+
+            date, id = Cursor(input).resume(self.sort)
+            # Continue strictly behind the last returned note, using the id
+            # as a tiebreaker for notes sharing the same date
+            operator = '$lt' if order == -1 else '$gt'
+            self.filter['$or'] = [
+                {key: {operator: date}},
+                {key: date, '_id': {operator: id}},
+            ]
         return self
 
     def bbox(self, input: str | None) -> Self:
@@ -113,11 +158,11 @@ class Filter(object):
             raise ValueError('Anonymous must be one of [include, hide, only]')
 
         if anonymous is not None:
-            # Filtering out anonymous notes means that there must be a user who created the note
+            # Anonymous notes were created without a user
             if anonymous == 'hide':
-                self.filter['comments.0.user'] = {'$exists': True}
+                self.filter['is_anonymous'] = False
             if anonymous == 'only':
-                self.filter['comments.0.user'] = {'$exists': False}
+                self.filter['is_anonymous'] = True
         return self
 
     def author(self, author: str | None) -> Self:
@@ -143,9 +188,9 @@ class Filter(object):
     def after(self, after: str | None) -> Self:
         if after is not None:
             key = self.sort[0]
-            # If results will be unsorted, use the creation date for the comparison
-            if key is None:
-                key = 'comments.0.date'
+            # If results will be unsorted (or not by date), use the creation date for the comparison
+            if key in [None, 'relevance']:
+                key = 'created_at'
 
             if key not in self.filter:
                 self.filter[key] = {}
@@ -155,9 +200,9 @@ class Filter(object):
     def before(self, before: str | None) -> Self:
         if before is not None:
             key = self.sort[0]
-            # If results will be unsorted, use the creation date for the comparison
-            if key is None:
-                key = 'comments.0.date'
+            # If results will be unsorted (or not by date), use the creation date for the comparison
+            if key in [None, 'relevance']:
+                key = 'created_at'
 
             if key not in self.filter:
                 self.filter[key] = {}
@@ -166,8 +211,22 @@ class Filter(object):
 
     def comments(self, amount_of_comments: str | None) -> Self:
         if amount_of_comments is not None:
-            # A comment of the note counts as everything after the original comment
-            self.filter['comments'] = {'$size': int(amount_of_comments) + 1}
+            # Either an exact amount of comments or a range of amounts,
+            # where one of the limits can be omitted (e.g. 2-5, 2- or -5)
+            minimum, separator, maximum = amount_of_comments.partition('-')
+            if separator == '':
+                self.filter['comment_count'] = int(amount_of_comments)
+            elif minimum == '' and maximum == '':
+                raise ValueError(
+                    'The range of comments needs at least one limit'
+                )
+            else:
+                condition = {}
+                if minimum != '':
+                    condition['$gte'] = int(minimum)
+                if maximum != '':
+                    condition['$lte'] = int(maximum)
+                self.filter['comment_count'] = condition
         return self
 
     def commented(self, commented: str | None) -> Self:
@@ -177,13 +236,9 @@ class Filter(object):
         if commented is not None:
             # Filtering out commented notes means that only the original comment exists
             if commented == 'hide':
-                self.filter['comments'] = {'$size': 1}
-            # Showing only commented notes requires the amount of comments to be greater than 1
-            # This is not directly allowed (since $size does not accept ranges of values, e.g. via $gt),
-            # so instead show only notes with an amount of comments different from 1
-            # (notes with 0 comments do not exist)
+                self.filter['comment_count'] = 0
             if commented == 'only':
-                self.filter['comments'] = {'$not': {'$size': 1}}
+                self.filter['comment_count'] = {'$gt': 0}
         return self
 
     # Remove values that are not defined or empty from a given dictionary
@@ -237,6 +292,182 @@ class Limit(object):
         return limit
 
 
+class Projection(object):
+    # Fields of a note which can be requested
+    FIELDS = [
+        'coordinates',
+        'status',
+        'updated_at',
+        'comments',
+        'created_at',
+        'comment_count',
+        'is_anonymous',
+        'last_action',
+        'last_user',
+    ]
+    # Predefined sets of fields and the amount of comments which are returned with them
+    VIEWS = {
+        'minimal': (['coordinates', 'status'], None),
+        'summary': (
+            [
+                'coordinates',
+                'status',
+                'updated_at',
+                'created_at',
+                'comment_count',
+                'last_action',
+                'last_user',
+                'comments',
+            ],
+            1,
+        ),
+        'full': (None, None),
+    }
+
+    def __init__(self, sort: tuple[str | None, int]) -> None:
+        self.sort = sort
+        self._fields = None
+        self._truncate = None
+
+    def view(self, view: str | None) -> Self:
+        if view is not None:
+            if view not in self.VIEWS:
+                raise ValueError(f'View must be one of {list(self.VIEWS)}')
+            self._fields, self._truncate = self.VIEWS[view]
+        return self
+
+    def fields(self, fields: str | None) -> Self:
+        if fields is not None:
+            if self._fields is not None:
+                raise ValueError('Fields can not be combined with a view')
+
+            self._fields = [field.strip() for field in fields.split(',')]
+            for field in self._fields:
+                if field not in self.FIELDS and field != '_id':
+                    raise ValueError(f'Fields must be some of {self.FIELDS}')
+        return self
+
+    # Return a field in any case, even if it was not requested (all fields are returned without a selection)
+    def include(self, field: str) -> Self:
+        if self._fields is not None and field not in self._fields:
+            self._fields = [*self._fields, field]
+        return self
+
+    # Only return the first (positive amount) or last (negative amount) comments
+    def truncate(self, truncate: str | None) -> Self:
+        if truncate is not None:
+            self._truncate = int(truncate)
+            if self._truncate == 0:
+                raise ValueError('The amount of comments must not be 0')
+        return self
+
+    def build(self) -> list[dict[str, Any]]:
+        comments = {'$slice': ['$comments', self._truncate]}
+
+        if self._fields is None:
+            # The fingerprint is only used internally to detect changes when importing notes
+            stages: list[dict[str, Any]] = [{'$unset': 'fingerprint'}]
+            if self._truncate is not None:
+                stages.append({'$set': {'comments': comments}})
+            return stages
+
+        projection: dict[str, Any] = {'_id': True}
+        for field in self._fields:
+            projection[field] = True
+        # The date used for sorting is required to continue the search with a cursor
+        key = self.sort[0]
+        if key is not None and key != 'relevance':
+            projection[key] = True
+        if 'comments' in projection and self._truncate is not None:
+            projection['comments'] = comments
+        return [{'$project': projection}]
+
+
+class Text(object):
+    def __init__(self, input: str) -> None:
+        # Phrases are wrapped in quotation marks and need to be contained exactly
+        self.phrases = [
+            phrase.strip()
+            for phrase in re.findall(r'"([^"]*)"', input)
+            if phrase.strip()
+        ]
+        self.words = []
+        self.excluded = []
+        # All other terms are separated by delimiters and can be excluded by prepending a dash
+        for term in re.sub(r'"[^"]*"?', ' ', input).split():
+            words = re.findall(r'\w+', term)
+            if term.startswith('-'):
+                self.excluded.extend(words)
+            else:
+                self.words.extend(words)
+        self.check()
+
+    def check(self) -> None:
+        if len(self.phrases) + len(self.words) == 0:
+            raise ValueError(
+                'The query must contain at least one word which is not excluded'
+            )
+
+    # Build the search string for the text index
+    def search(self) -> str:
+        return ' '.join(
+            [f'"{phrase}"' for phrase in self.phrases]
+            + self.words
+            + [f'-{word}' for word in self.excluded]
+        )
+
+    # Build the conditions for a single text field, following the semantics of the text search:
+    # if there are phrases, all of them need to be present, otherwise at least one of the words
+    def first(self) -> dict[str, list[re.Pattern]]:
+        if len(self.phrases) > 0:
+            return {'$all': [self.pattern(x) for x in self.phrases]}
+        return {'$in': [self.pattern(x) for x in self.words]}
+
+    def pattern(self, term: str) -> re.Pattern:
+        return re.compile(re.escape(term), re.IGNORECASE)
+
+
+class Cursor(object):
+    # Dates are stored with millisecond precision in the database
+    EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    PRECISION = datetime.timedelta(milliseconds=1)
+
+    def __init__(self, input: str) -> None:
+        try:
+            padding = '=' * (-len(input) % 4)
+            decoded = orjson.loads(base64.urlsafe_b64decode(input + padding))
+            self.key, self.order, self.date, self.id = decoded
+            if type(self.date) is not int or type(self.id) is not int:
+                raise TypeError
+        except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError):
+            raise ValueError('The cursor is invalid')
+
+    def resume(
+        self, sort: tuple[str | None, int]
+    ) -> tuple[datetime.datetime, int]:
+        if (self.key, self.order) != sort:
+            raise ValueError(
+                'The cursor was issued for a different sort criteria or order'
+            )
+        return self.EPOCH + self.date * self.PRECISION, self.id
+
+    # Create the cursor pointing behind the given (last returned) note
+    @classmethod
+    def encode(cls, sort: tuple[str | None, int], document: dict) -> str:
+        key, order = sort
+        value: Any = document
+        for part in str(key).split('.'):
+            value = value[int(part)] if part.isdigit() else value[part]
+
+        # Dates returned by the database are naive, but always in UTC
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        date = (value - cls.EPOCH) // cls.PRECISION
+
+        encoded = orjson.dumps([key, order, date, document['_id']])
+        return base64.urlsafe_b64encode(encoded).decode().rstrip('=')
+
+
 class BoundingBox(object):
     def __init__(self, input: str) -> None:
         bbox = [float(x) for x in input.split(',')]
@@ -288,14 +519,22 @@ class Polygon(object):
 
 
 class Users(object):
-    def __init__(self) -> None:
-        with open(
-            os.path.join(os.path.dirname(__file__), 'grammars', 'users.lark')
-        ) as file:
-            self.grammar = lark.Lark(file.read())
+    # Building the parser is much more expensive than parsing the usually short input,
+    # so the grammar is only compiled once for the whole process.
+    # The Earley parser is still used, because the grammar relies on its dynamic lexer
+    # (e.g. to correctly separate "NOT " from a user name which can contain spaces)
+    grammar = lark.Lark.open('grammars/users.lark', rel_to=__file__)
 
     def parse(self, input: str) -> tuple[list[Any], list[Any]]:
-        tree = self.grammar.parse(input)
+        with span('users'):
+            include, exclude = self.cached(input)
+        # Return copies to prevent modifications of the cached results
+        return list(include), list(exclude)
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def cached(cls, input: str) -> tuple[tuple[Any, ...], tuple[Any, ...]]:
+        tree = cls.grammar.parse(input)
         include = []
         exclude = []
 
@@ -315,4 +554,4 @@ class Users(object):
                 'The amount of users to search for exceeds the limit'
             )
 
-        return include, exclude
+        return tuple(include), tuple(exclude)
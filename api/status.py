@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import hashlib
+import os
+
+import orjson
+from pymongo.errors import PyMongoError
+from sanic import Sanic
+from sanic.log import logger
+
+# Files written by the scripts which contain the date of their last (successful) run
+FILES = {
+    'last_import': 'LAST_IMPORT.txt',
+    'last_sync': 'LAST_SYNC.txt',
+    'last_update': 'LAST_UPDATE.txt',
+}
+
+
+# Poll the status document which is written by the scripts after they changed any notes,
+# so that cached responses can be invalidated as soon as a new version of the data is available.
+# The status information about the database is refreshed at the same time,
+# so that it does not need to be read for every request.
+# The names of the existing indices are read as well, since only these can be used as hints
+async def refresh_status(app: Sanic) -> None:
+    dates = {}
+    modified = {}
+    notes = None
+
+    while True:
+        try:
+            status = await app.ctx.db.status.find_one({'_id': 'notes'})
+            notes = await app.ctx.db.notes.estimated_document_count()
+            cursor = await app.ctx.db.notes.list_indexes()
+            app.ctx.indices = {index['name'] async for index in cursor}
+        except PyMongoError as error:
+            logger.warning(f'Could not read the status document: {error}')
+        else:
+            status = status or {}
+            if status.get('version', 0) != app.ctx.status.get('version', 0):
+                app.ctx.responses.clear()
+            app.ctx.status = status
+
+        await asyncio.to_thread(read, app.config.ROOT_PATH, dates, modified)
+        app.ctx.summary = summarize(dates, modified, notes)
+        await asyncio.sleep(app.config.STATUS_INTERVAL)
+
+
+# Read the dates of the files that were modified since they were read the last time
+def read(root: str, dates: dict, modified: dict) -> None:
+    for key, name in FILES.items():
+        path = os.path.join(root, 'scripts', name)
+        try:
+            mtime = os.stat(path).st_mtime
+            if modified.get(key) != mtime:
+                with open(path) as file:
+                    dates[key] = file.read().strip()
+                modified[key] = mtime
+        except OSError:
+            dates[key] = None
+            modified.pop(key, None)
+
+
+def summarize(dates: dict, modified: dict, notes: int | None) -> dict:
+    # Seconds since the last update of the notes
+    lag = None
+    if dates.get('last_update') is not None:
+        try:
+            last_update = datetime.datetime.fromisoformat(dates['last_update'])
+            lag = round(
+                (
+                    datetime.datetime.now(datetime.timezone.utc) - last_update
+                ).total_seconds()
+            )
+        except (TypeError, ValueError):
+            pass
+
+    values = {
+        **{key: dates.get(key) for key in FILES},
+        'notes': notes,
+    }
+    return {
+        'values': {**values, 'update_lag': lag},
+        # The lag changes all the time, so it is not part of the version of the status
+        'etag': hashlib.sha256(orjson.dumps(values)).hexdigest()[:32],
+        'modified': max(modified.values(), default=None),
+    }
+
+
+# The current version of the data, which changes with every update of the notes
+def version() -> int:
+    return Sanic.get_app().ctx.status.get('version', 0)
@@ -0,0 +1,144 @@
+import math
+from typing import Any
+
+# The maximum latitude which can be displayed with the Web Mercator projection
+MAX_LATITUDE = 85.0511287798
+# Share of the size of a tile which is added around its polygon (see geometry())
+PADDING = 0.01
+
+
+# Calculate the tile (x, y) of the given zoom level which contains a position
+def tile(longitude: float, latitude: float, zoom: int) -> tuple[int, int]:
+    n = 2**zoom
+    latitude = math.radians(max(min(latitude, MAX_LATITUDE), -MAX_LATITUDE))
+    x = math.floor((longitude + 180) / 360 * n)
+    y = math.floor(
+        (1 - math.log(math.tan(latitude) + 1 / math.cos(latitude)) / math.pi)
+        / 2
+        * n
+    )
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+# Calculate the bounding box (west, south, east, north) of a tile
+def bounds(zoom: int, x: int, y: int) -> tuple[float, float, float, float]:
+    n = 2**zoom
+
+    def latitude(y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (
+        x / n * 360 - 180,
+        latitude(y + 1),
+        (x + 1) / n * 360 - 180,
+        latitude(y),
+    )
+
+
+# A GeoJSON polygon around a tile, which can be answered by the geospatial index (unlike a $box).
+# The edges of the polygon are geodesics in the database, which bend slightly towards the poles,
+# so the polygon is padded and the notes need to be checked with tile() afterwards.
+# The tiles at the border of the map also contain the notes beyond the maximum latitude
+def geometry(zoom: int, x: int, y: int) -> dict[str, Any]:
+    west, south, east, north = bounds(zoom, x, y)
+    dx = (east - west) * PADDING
+    dy = (north - south) * PADDING
+    west, east = max(west - dx, -180), min(east + dx, 180)
+    south = -90 if y == 2**zoom - 1 else max(south - dy, -90)
+    north = 90 if y == 0 else min(north + dy, 90)
+    return {
+        'type': 'Polygon',
+        'coordinates': [
+            [
+                [west, south],
+                [east, south],
+                [east, north],
+                [west, north],
+                [west, south],
+            ]
+        ],
+    }
+
+
+# Keep only the features of a collection which are contained in the given tile,
+# which is used to get the features of a tile from the collection of a larger tile containing it
+def clip(
+    collection: dict[str, Any], zoom: int, x: int, y: int
+) -> dict[str, Any]:
+    features = []
+    for feature in collection['features']:
+        longitude, latitude = feature['geometry']['coordinates']
+        if tile(longitude, latitude, zoom) == (x, y):
+            features.append(feature)
+    return {**collection, 'features': features}
+
+
+# The same calculation as tile() as an expression of an aggregation,
+# which returns the tile containing the coordinates of a note
+def expression(zoom: int) -> dict[str, Any]:
+    n = 2**zoom
+    longitude = {'$arrayElemAt': ['$coordinates', 0]}
+    latitude = {
+        '$degreesToRadians': {
+            '$max': [
+                {
+                    '$min': [
+                        {'$arrayElemAt': ['$coordinates', 1]},
+                        MAX_LATITUDE,
+                    ]
+                },
+                -MAX_LATITUDE,
+            ]
+        }
+    }
+
+    def clamp(value: dict[str, Any]) -> dict[str, Any]:
+        return {'$toInt': {'$max': [{'$min': [{'$floor': value}, n - 1]}, 0]}}
+
+    # The latitude is projected with ln(tan(latitude) + sec(latitude)) / pi
+    secant = {'$divide': [1, {'$cos': latitude}]}
+    projected = {
+        '$divide': [{'$ln': {'$add': [{'$tan': latitude}, secant]}}, math.pi]
+    }
+    return {
+        'x': clamp(
+            {'$multiply': [{'$divide': [{'$add': [longitude, 180]}, 360]}, n]}
+        ),
+        'y': clamp(
+            {'$multiply': [{'$divide': [{'$subtract': [1, projected]}, 2]}, n]}
+        ),
+    }
+
+
+# Group the notes by the tile of the given zoom level which contains them
+# and count them by their status, the position of each cluster is the center of its notes
+def grid(zoom: int, limit: int) -> list[dict[str, Any]]:
+    return [
+        {
+            '$group': {
+                '_id': expression(zoom),
+                'count': {'$sum': 1},
+                'open': {
+                    '$sum': {'$cond': [{'$eq': ['$status', 'open']}, 1, 0]}
+                },
+                'closed': {
+                    '$sum': {'$cond': [{'$eq': ['$status', 'closed']}, 1, 0]}
+                },
+                'longitude': {'$avg': {'$arrayElemAt': ['$coordinates', 0]}},
+                'latitude': {'$avg': {'$arrayElemAt': ['$coordinates', 1]}},
+            }
+        },
+        # Keep the largest clusters if there are too many of them
+        {'$sort': {'count': -1, '_id': 1}},
+        {'$limit': limit},
+        {
+            '$project': {
+                '_id': False,
+                'tile': [zoom, '$_id.x', '$_id.y'],
+                'coordinates': ['$longitude', '$latitude'],
+                'count': True,
+                'open': True,
+                'closed': True,
+            }
+        },
+    ]
@@ -1,14 +1,23 @@
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 
 from jwt import PyJWKClient
 from pymongo import AsyncMongoClient
 from sanic import Blueprint, Sanic
 
-from api.auth import attach_uid
+from api.auth import Keys, attach_uid, refresh_keys
+from api.cache import Cache
+from api.feed import Feed, watch
+from api.metrics import STAGES, Histograms, measure, report
+from api.status import refresh_status, summarize
 from blueprints.auth import blueprint as auth
+from blueprints.feed import blueprint as feed
+from blueprints.metrics import blueprint as metrics
 from blueprints.notes import blueprint as notes
 from blueprints.search import blueprint as search
 from blueprints.status import blueprint as status
+from blueprints.tiles import blueprint as tiles
 from config import Config
 
 app = Sanic(__name__)
@@ -34,6 +43,19 @@ app.ext.openapi.add_security_scheme(
 )
 
 
+@app.main_process_start
+async def share(app: Sanic) -> None:
+    # Times of the last modification of cached data of each user (by their uid),
+    # which is shared between all workers to invalidate their caches
+    app.shared_ctx.invalidations = multiprocessing.get_context(
+        'spawn'
+    ).RawArray('d', app.config.INVALIDATION_SLOTS)
+    # Histograms of the durations of requests, which are observed by all workers
+    app.shared_ctx.histograms = multiprocessing.get_context('spawn').Array(
+        'd', len(STAGES) * Histograms.SLOTS
+    )
+
+
 @app.before_server_start
 async def setup(app: Sanic) -> None:
     client = AsyncMongoClient(
@@ -49,14 +71,61 @@ async def setup(app: Sanic) -> None:
 
     app.ctx.client = client
     app.ctx.db = client.notesreview
-    app.ctx.jwks_client = jwks_client
+    app.ctx.keys = Keys(jwks_client)
+    # Verified tokens (by their hash) and the tokens currently used by each user (by their uid)
+    app.ctx.tokens = Cache(
+        app.config.TOKEN_CACHE_SIZE, app.config.TOKEN_CACHE_TTL
+    )
+    invalidations = getattr(app.shared_ctx, 'invalidations', None)
+    app.ctx.sessions = Cache(
+        app.config.TOKEN_CACHE_SIZE,
+        app.config.TOKEN_CACHE_TTL,
+        invalidations,
+    )
+
+    # Responses of anonymous searches which are valid until the notes are updated
+    app.ctx.responses = Cache(
+        app.config.SEARCH_CACHE_SIZE, app.config.SEARCH_CACHE_TTL
+    )
+    app.ctx.status = {}
+    # Names of the existing indices of the notes, no hints are used until they are known
+    app.ctx.indices = set()
+    app.ctx.summary = summarize({}, {}, None)
+    # Entries of the personal watchlist and blocklist of each user
+    app.ctx.watchlists = Cache(
+        app.config.LIST_CACHE_SIZE, app.config.LIST_CACHE_TTL, invalidations
+    )
+    app.ctx.blocklists = Cache(
+        app.config.LIST_CACHE_SIZE, app.config.LIST_CACHE_TTL, invalidations
+    )
+
+    # Threads used for steps which need a lot of CPU time (see api.executor)
+    app.ctx.executor = ThreadPoolExecutor(
+        app.config.EXECUTOR_WORKERS, thread_name_prefix='executor'
+    )
+    app.ctx.histograms = Histograms(
+        getattr(app.shared_ctx, 'histograms', None)
+    )
+
+    app.add_task(refresh_keys(app), name='refresh_keys')
+    app.add_task(refresh_status(app), name='refresh_status')
+
+    # Changed notes are read once per worker and sent to all clients of the live feed
+    app.ctx.feed = Feed(app.config.FEED_QUEUE_SIZE)
+    app.add_task(watch(app), name='watch')
 
 
 @app.before_server_stop
 async def shutdown(app: Sanic) -> None:
     app.ctx.client.close()
+    app.ctx.executor.shutdown(wait=False, cancel_futures=True)
 
 
-app.blueprint(Blueprint.group(auth, status, notes, search))
+app.blueprint(
+    Blueprint.group(auth, status, notes, search, tiles, feed, metrics)
+)
 
+# The durations are measured before the user is authenticated, which is measured as well
+app.register_middleware(measure, 'request')
 app.register_middleware(attach_uid, 'request')
+app.register_middleware(report, 'response')
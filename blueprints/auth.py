@@ -37,7 +37,7 @@ async def login(request: Request) -> HTTPResponse:
         return text('No token provided', 401)
 
     try:
-        info = decode_token(token)
+        info = await decode_token(token)
     except jwt.exceptions.InvalidTokenError:
         return text('The provided token is invalid', 401)
 
@@ -69,6 +69,8 @@ async def login(request: Request) -> HTTPResponse:
         },
         upsert=True,
     )
+    # The user might have used a different token before
+    Sanic.get_app().ctx.sessions.delete(uid)
 
     return text('OK', 200)
 
@@ -121,7 +123,7 @@ async def userinfo(request: Request) -> HTTPResponse | JSONResponse:
         return text('No token provided', 401)
 
     try:
-        info['token'] = decode_token(token)
+        info['token'] = await decode_token(token)
     except jwt.exceptions.InvalidTokenError:
         return text('The provided token is invalid', 401)
 
@@ -164,4 +166,5 @@ async def logout(request: Request) -> HTTPResponse:
         },
         {'$set': {'token': None}},
     )
+    Sanic.get_app().ctx.sessions.delete(request.ctx.uid)
     return text('OK', 200)
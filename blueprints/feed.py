@@ -0,0 +1,78 @@
+import asyncio
+from textwrap import dedent
+
+import orjson
+from sanic import Blueprint, Sanic
+from sanic.request import Request
+from sanic.response import HTTPResponse, json
+from sanic_ext import openapi
+
+from api.matcher import predicate
+from blueprints.search import parse
+
+blueprint = Blueprint('Feed', url_prefix='/feed')
+
+
+@blueprint.route('/')
+@openapi.summary('Live feed')
+@openapi.description(
+    dedent(
+        """\
+        Receive all notes which are created or changed from now on as Server-Sent Events.
+        The same filters as for a search can be used, except the ones for sorting, limiting and paginating the results.
+        Every changed note is sent as an event of the type `note`, which contains the note as JSON.
+        If the client does not receive the notes fast enough, an event of the type `overflow` is sent and the stream is closed,
+        in this case the missed notes need to be searched before connecting again.
+        """
+    )
+)
+@openapi.response(
+    200,
+    {'text/event-stream': openapi.String()},
+    'The response is a stream of events containing the changed notes',
+)
+@openapi.response(
+    400,
+    {
+        'application/json': openapi.Object(
+            properties={'error': openapi.String()}
+        )
+    },
+    'In case one of the parameters is invalid, the response contains the error message',
+)
+async def feed(request: Request) -> HTTPResponse | None:
+    app = Sanic.get_app()
+    try:
+        uid = request.ctx.uid if hasattr(request.ctx, 'uid') else None
+        _, filter, _, _ = await parse(request.args, uid)
+        matches = predicate(filter)
+    except ValueError as error:
+        return json({'error': str(error)}, status=400)
+
+    subscription = app.ctx.feed.subscribe(matches)
+    try:
+        response = await request.respond(
+            headers={'Cache-Control': 'no-cache'},
+            content_type='text/event-stream',
+        )
+        while True:
+            try:
+                note = await asyncio.wait_for(
+                    subscription.queue.get(), app.config.FEED_KEEPALIVE
+                )
+            except TimeoutError:
+                # Comments keep the connection open without being visible to the client
+                await response.send(': keepalive\n\n')
+                continue
+
+            await response.send(
+                b'event: note\ndata: '
+                + orjson.dumps(note, option=orjson.OPT_NAIVE_UTC)
+                + b'\n\n'
+            )
+            if subscription.overflowed and subscription.queue.empty():
+                await response.send('event: overflow\ndata: {}\n\n')
+                break
+    finally:
+        app.ctx.feed.unsubscribe(subscription)
+    await response.eof()
@@ -0,0 +1,36 @@
+import hmac
+
+from sanic import Blueprint, Sanic
+from sanic.exceptions import Unauthorized
+from sanic.request import Request
+from sanic.response import HTTPResponse, text
+from sanic_ext import openapi
+
+blueprint = Blueprint('Metrics', url_prefix='/metrics')
+
+
+@blueprint.route('/')
+@openapi.summary('Metrics')
+@openapi.description(
+    'Histograms of the durations of the stages of all requests in the text format of Prometheus. '
+    'The metrics are public, unless a token is configured (see METRICS_TOKEN), which then needs to be sent as a bearer token'
+)
+@openapi.response(
+    200,
+    {'text/plain': openapi.String()},
+    'The response contains the histograms of all workers',
+)
+@openapi.response(
+    401,
+    description='A token is configured, but it was not sent',
+)
+async def metrics(request: Request) -> HTTPResponse:
+    token = Sanic.get_app().config.METRICS_TOKEN
+    if token is not None and not hmac.compare_digest(
+        (request.token or '').encode(), token.encode()
+    ):
+        raise Unauthorized('You are unauthorized')
+    return text(
+        Sanic.get_app().ctx.histograms.export(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
@@ -6,6 +6,7 @@ from sanic.request import Request
 from sanic.response import HTTPResponse, JSONResponse, json, text
 from sanic_ext import openapi
 
+from api import lists
 from api.auth import protected
 
 blueprint = Blueprint('Blocklist', url_prefix='/blocklist')
@@ -69,6 +70,9 @@ async def hide(request: Request, id: int) -> HTTPResponse:
         },
         upsert=True,
     )
+    Sanic.get_app().ctx.blocklists.update(
+        request.ctx.uid, lambda ids: ids if int(id) in ids else [*ids, int(id)]
+    )
     return text('OK', 200)
 
 
@@ -99,6 +103,9 @@ async def unhide(request: Request, id: int) -> HTTPResponse:
             'user': request.ctx.uid,
         }
     )
+    Sanic.get_app().ctx.blocklists.update(
+        request.ctx.uid, lambda ids: [x for x in ids if x != int(id)]
+    )
     return text('OK', 200)
 
 
@@ -119,10 +126,7 @@ async def unhide(request: Request, id: int) -> HTTPResponse:
 @protected
 async def blocklist(request: Request) -> JSONResponse:
     # List all hidden notes for the current user
-    uid = request.ctx.uid
-    ids = await Sanic.get_app().ctx.db.blocklist.distinct(
-        'note', {'user': uid}
-    )
+    ids = await lists.blocklist(request.ctx.uid)
     return json(ids, dumps=orjson.dumps, option=orjson.OPT_NAIVE_UTC)
 
 
@@ -145,4 +149,5 @@ async def delete_blocklist(request: Request) -> HTTPResponse:
             'user': request.ctx.uid,
         }
     )
+    Sanic.get_app().ctx.blocklists.update(request.ctx.uid, lambda ids: [])
     return text('OK', 200)
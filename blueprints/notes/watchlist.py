@@ -72,6 +72,7 @@ async def watch(request: Request, id: int) -> HTTPResponse:
         },
         upsert=True,
     )
+    Sanic.get_app().ctx.watchlists.delete(request.ctx.uid)
     return text('OK', 200)
 
 
@@ -102,6 +103,7 @@ async def unwatch(request: Request, id: int) -> HTTPResponse:
             'user': request.ctx.uid,
         }
     )
+    Sanic.get_app().ctx.watchlists.delete(request.ctx.uid)
     return text('OK', 200)
 
 
@@ -167,4 +169,5 @@ async def delete_watchlist(request: Request) -> HTTPResponse:
             'user': request.ctx.uid,
         }
     )
+    Sanic.get_app().ctx.watchlists.delete(request.ctx.uid)
     return text('OK', 200)
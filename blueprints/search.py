@@ -1,20 +1,40 @@
+import asyncio
+import datetime
+import hashlib
+import re
+import time
 from textwrap import dedent
 from typing import Any
 
+import msgpack
 import orjson
+from bson import json_util
 from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import PyMongoError
 from sanic import Blueprint, Sanic
+from sanic.log import logger
 from sanic.request import Request, RequestParameters
-from sanic.response import JSONResponse, json
+from sanic.response import HTTPResponse, empty, json, raw
 from sanic_ext import openapi
 
+from api import counts, lists, metrics, planner, status, tiles
+from api.executor import offload
+from api.http import matches
+from api.models.cluster import Cluster
 from api.models.note import Note
-from api.query import Filter, Limit, Sort
+from api.query import Cursor, Filter, Limit, Projection, Sort
 from config import Config
 
 blueprint = Blueprint('Search', url_prefix='/search')
 config = Config()
 
+# Content types of the formats which are not streamed
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'geojson': 'application/geo+json',
+    'msgpack': 'application/msgpack',
+}
+
 
 @blueprint.route('/', methods=['GET', 'POST'])
 @openapi.summary('Search')
@@ -29,6 +49,8 @@ config = Config()
             Single words can be excluded from the result by prepending a dash `-` to the word.
             Spaces and other delimiters like dots are currently treated as a logical OR,
             though this will likely change in the future.
+            A regular expression can be used by prepending `regex:` to the query,
+            but note that such a search is a lot slower.
             """
         ),
         default=None,
@@ -106,10 +128,10 @@ config = Config()
 )
 @openapi.parameter(
     'comments',
-    openapi.Integer(
-        description='Filters the amount of comments on a note',
-        minimum=0,
+    openapi.String(
+        description='Filters the amount of comments on a note, either exactly or by a range where one of the limits can be omitted (e.g. `2-5`, `2-` or `-5`)',
         default=None,
+        example='1-',
     ),
 )
 @openapi.parameter(
@@ -131,8 +153,8 @@ config = Config()
 @openapi.parameter(
     'sort_by',
     openapi.String(
-        description='Sort notes either by no criteria, the date of the last update or their creation date',
-        enum=('none', 'updated_at', 'created_at'),
+        description='Sort notes either by no criteria, the date of the last update, their creation date or the relevance for the query',
+        enum=('none', 'updated_at', 'created_at', 'relevance'),
         default='updated_at',
     ),
 )
@@ -153,9 +175,99 @@ config = Config()
         default=config.DEFAULT_LIMIT,
     ),
 )
+@openapi.parameter(
+    'cursor',
+    openapi.String(
+        description=dedent(
+            """\
+            An opaque token to continue a previous search behind the last returned note.
+            If more results are available, the token for the next page is returned in the `X-Cursor` header
+            of the response. The token can only be used with the same sort criteria and order.
+            """
+        ),
+        default=None,
+    ),
+)
+@openapi.parameter(
+    'format',
+    openapi.String(
+        description=dedent(
+            """\
+            The format of the response, either a JSON array, newline delimited JSON
+            which is streamed while the notes are read from the database, a GeoJSON feature collection
+            (which always contains the coordinates) or a MessagePack array, which is more compact than JSON.
+            Newline delimited JSON, GeoJSON or MessagePack is also used if the `Accept` header contains
+            `application/x-ndjson`, `application/geo+json` or `application/msgpack`.
+            No cursor is provided for newline delimited JSON.
+            """
+        ),
+        enum=('json', 'ndjson', 'geojson', 'msgpack'),
+        default='json',
+    ),
+)
+@openapi.parameter(
+    'view',
+    openapi.String(
+        description=dedent(
+            """\
+            A predefined set of fields which are returned for each note:
+            `minimal` (coordinates and status), `summary` (the most important information and the first comment)
+            or `full` (all information)
+            """
+        ),
+        enum=tuple(Projection.VIEWS),
+        default='full',
+    ),
+)
+@openapi.parameter(
+    'fields',
+    openapi.String(
+        description=dedent(
+            """\
+            The fields which are returned for each note separated by a comma, which can not be combined with a view.
+            The id of the note and the date used for sorting are always returned.
+            """
+        ),
+        default=None,
+        example='coordinates,status,comment_count',
+    ),
+)
+@openapi.parameter(
+    'truncate',
+    openapi.Integer(
+        description='Only return the first (positive amount) or last (negative amount) comments of a note',
+        default=None,
+    ),
+)
+@openapi.parameter(
+    'layout',
+    openapi.String(
+        description=dedent(
+            """\
+            Either return an array of notes (`rows`) or an object containing an array for each field (`columns`),
+            where the coordinates are split into the fields `longitude` and `latitude`.
+            The layout can only be used for JSON responses.
+            """
+        ),
+        enum=('rows', 'columns'),
+        default='rows',
+    ),
+)
+@openapi.parameter(
+    'explain',
+    openapi.Boolean(
+        description='Return the query plan of the search instead of the results (only available if enabled in the configuration)',
+        default=False,
+    ),
+)
 @openapi.response(
     200,
-    {'application/json': openapi.Array(items=Note, uniqueItems=True)},
+    {
+        'application/json': openapi.Array(items=Note, uniqueItems=True),
+        'application/x-ndjson': Note,
+        'application/geo+json': openapi.Object(),
+        'application/msgpack': openapi.Array(items=Note, uniqueItems=True),
+    },
     'The response is an array containing the notes with the requested information',
 )
 @openapi.response(
@@ -167,7 +279,11 @@ config = Config()
     },
     'In case one of the parameters is invalid, the response contains the error message',
 )
-async def index(request: Request) -> JSONResponse:
+@openapi.response(
+    304,
+    description='The results of the search did not change since the last request with the same parameters',
+)
+async def index(request: Request) -> HTTPResponse | None:
     try:
         args = {}
         if request.method == 'GET':
@@ -176,22 +292,339 @@ async def index(request: Request) -> JSONResponse:
             args = request.json
         uid = request.ctx.uid if hasattr(request.ctx, 'uid') else None
         sort, filter, limit, watchlist = await parse(args, uid)
+        format = negotiate(request, args)
+        projection, layout = present(args, sort, format)
     except ValueError as error:
         return json({'error': str(error)}, status=400)
 
-    collection, pipeline = build(sort, filter, limit, watchlist, uid)
-    return await find(collection, pipeline)
+    collection, pipeline = build(sort, filter, limit, projection)
+
+    # Choose the index depending on the shape of the search
+    config = Sanic.get_app().config
+    shape, hint = planner.plan(
+        sort,
+        filter,
+        config.QUERY_HINTS,
+        config.GEO_SELECTIVE_AREA,
+        Sanic.get_app().ctx.indices,
+    )
+    options: dict[str, Any] = {} if hint is None else {'hint': hint}
+
+    if config.SEARCH_EXPLAIN and str(args.get('explain')).lower() == 'true':
+        return await explain(collection, pipeline, shape, options)
+
+    # The results of anonymous searches are the same for everyone
+    # and can therefore be cached until the notes are updated the next time
+    key = None
+    headers = {}
+    if uid is None:
+        key = fingerprint(
+            'search', sort, filter, limit, format, projection, layout
+        )
+        headers = {'ETag': f'W/"{key}"', 'Cache-Control': 'no-cache'}
+        if request.method == 'GET' and matches(request, headers['ETag']):
+            return empty(304, headers=headers)
+
+    if format == 'ndjson':
+        return await stream(
+            request, collection, pipeline, options, watchlist, headers
+        )
+
+    responses = Sanic.get_app().ctx.responses
+    if key is not None:
+        cached = responses.get(key)
+        if cached is not None:
+            body, cached_headers, content_type = cached
+            return raw(
+                body,
+                headers={**cached_headers, **headers},
+                content_type=content_type,
+            )
+
+    response = await find(
+        collection, pipeline, options, watchlist, sort, limit, layout, format
+    )
+    if key is not None:
+        responses.set(
+            key,
+            (response.body, dict(response.headers), response.content_type),
+        )
+        response.headers.update(headers)
+    return response
+
+
+@blueprint.route('/clusters', methods=['GET', 'POST'])
+@openapi.summary('Clusters')
+@openapi.description(
+    dedent(
+        """\
+        Count the notes matching a search in the cells of a grid, which becomes finer with higher zoom levels.
+        The same parameters as for a search can be used, except the ones for sorting, limiting and paginating the results,
+        which are rejected (so `after` and `before` always refer to the date of the last update).
+        For lower zoom levels the notes are counted in advance, if they are only filtered by their status and a bounding box
+        (the cells at the border of the bounding box then contain all of their notes).
+        Otherwise the notes are grouped for each request, which requires a bounding box or a polygon
+        spanning at most a few tiles of the map at the given zoom level (unless the notes are filtered by users).
+        """
+    )
+)
+@openapi.parameter(
+    'zoom',
+    openapi.Integer(
+        description='The zoom level of the map, which determines the size of the cells',
+        minimum=0,
+        maximum=config.MAX_ZOOM,
+        default=0,
+    ),
+)
+@openapi.parameter(
+    'bbox',
+    openapi.String(
+        description='Only count notes in the given bounding box (in the format `min_lon,min_lat,max_lon,max_lat`)',
+        default=None,
+    ),
+)
+@openapi.response(
+    200,
+    {'application/json': openapi.Array(items=Cluster)},
+    'The response is an array containing the amount of notes in each cell which contains at least one note',
+)
+@openapi.response(
+    400,
+    {
+        'application/json': openapi.Object(
+            properties={'error': openapi.String()}
+        )
+    },
+    'In case one of the parameters is invalid, the response contains the error message',
+)
+@openapi.response(
+    304,
+    description='The clusters did not change since the last request with the same parameters',
+)
+async def clusters(request: Request) -> HTTPResponse:
+    app = Sanic.get_app()
+    try:
+        args = {}
+        if request.method == 'GET':
+            args = request.args
+        elif request.method == 'POST':
+            args = request.json
+        uid = request.ctx.uid if hasattr(request.ctx, 'uid') else None
+        unsupported = [
+            key
+            for key in ['sort_by', 'order', 'limit', 'cursor']
+            if key in args
+        ]
+        if len(unsupported) > 0:
+            raise ValueError(
+                f'Clusters can not be used with [{", ".join(unsupported)}]'
+            )
+        _, filter, _, _ = await parse(args, uid)
+
+        zoom = int(args.get('zoom', 0))
+        if zoom < 0 or zoom > app.config.MAX_ZOOM:
+            raise ValueError(
+                f'Zoom must be between 0 and {app.config.MAX_ZOOM}'
+            )
+        level = zoom + app.config.CLUSTER_DETAIL
+
+        # The clusters are not sorted by any date, so only the conditions determine the index
+        shape, hint = planner.plan(
+            (None, -1),
+            filter,
+            app.config.QUERY_HINTS,
+            app.config.GEO_SELECTIVE_AREA,
+            app.ctx.indices,
+        )
+        # The zoom level up to which the notes were counted in advance is stored together with the status
+        counted = counts.supported(filter) and level <= app.ctx.status.get(
+            'clusters', -1
+        )
+        if not counted and shape not in ['ids', 'author', 'user']:
+            region = filter.get('coordinates', {}).get('$geoWithin')
+            bounds = None if region is None else planner.extent(region)
+            if bounds is None:
+                raise ValueError(
+                    f'Clusters at zoom {zoom} require a bounding box or a polygon'
+                )
+            west, south, east, north = bounds
+            if (
+                max(east - west, north - south)
+                > 360 / 2**zoom * app.config.CLUSTER_MAX_SPAN
+            ):
+                raise ValueError(
+                    f'The region is too large for clusters at zoom {zoom}'
+                )
+    except ValueError as error:
+        return json({'error': str(error)}, status=400)
+
+    options: dict[str, Any] = {} if hint is None else {'hint': hint}
+    pipeline = [
+        {'$match': filter},
+        *tiles.grid(level, app.config.MAX_CLUSTERS),
+    ]
+
+    key = None
+    headers = {}
+    if uid is None:
+        key = fingerprint('clusters', filter, level)
+        headers = {'ETag': f'W/"{key}"', 'Cache-Control': 'no-cache'}
+        if request.method == 'GET' and matches(request, headers['ETag']):
+            return empty(304, headers=headers)
+
+        cached = app.ctx.responses.get(key)
+        if cached is not None:
+            body, _, content_type = cached
+            return raw(body, headers=headers, content_type=content_type)
+
+    if counted:
+        with metrics.span('iterate'):
+            result = await counts.clusters(
+                app.ctx.db, filter, level, app.config.MAX_CLUSTERS
+            )
+    else:
+        started = time.perf_counter()
+        with metrics.span('aggregate'):
+            cursor = await app.ctx.db.notes.aggregate(pipeline, **options)
+        with metrics.span('iterate'):
+            result = await cursor.to_list()
+        slow(
+            app.ctx.db.notes, pipeline, options, time.perf_counter() - started
+        )
+    with metrics.span('serialize'):
+        response = json(result, headers=headers, dumps=orjson.dumps)
+    if key is not None:
+        app.ctx.responses.set(key, (response.body, {}, response.content_type))
+    return response
+
+
+# Identify a request by its normalized parameters and the current version of the data
+def fingerprint(*parameters: Any) -> str:  # noqa: ANN401
+    def default(value: Any) -> Any:  # noqa: ANN401
+        if isinstance(value, re.Pattern):
+            return [value.pattern, value.flags]
+        raise TypeError
+
+    serialized = orjson.dumps(
+        [status.version(), *parameters],
+        default=default,
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NAIVE_UTC,
+    )
+    return hashlib.sha256(serialized).hexdigest()
+
+
+# Determine the format of the response either from the parameters or the accepted content types
+def negotiate(
+    request: Request, data: RequestParameters | dict[str, Any]
+) -> str:
+    format = data.get('format')
+    if format is None:
+        if request.accept.match(
+            'application/x-ndjson', accept_wildcards=False
+        ):
+            format = 'ndjson'
+        elif request.accept.match(
+            'application/geo+json', accept_wildcards=False
+        ):
+            format = 'geojson'
+        elif accepts_msgpack(request):
+            format = 'msgpack'
+        else:
+            format = 'json'
+
+    if format not in ['json', 'ndjson', 'geojson', 'msgpack']:
+        raise ValueError(
+            'Format must be one of [json, ndjson, geojson, msgpack]'
+        )
+    return format
+
+
+def accepts_msgpack(request: Request) -> bool:
+    return any(
+        request.accept.match(content_type, accept_wildcards=False)
+        for content_type in ['application/msgpack', 'application/x-msgpack']
+    )
+
+
+# Determine which fields of the notes are returned and how they are arranged in the response
+def present(
+    data: RequestParameters | dict[str, Any],
+    sort: tuple[str | None, int],
+    format: str,
+) -> tuple[list[dict[str, Any]], str]:
+    projection = (
+        Projection(sort)
+        .view(data.get('view'))
+        .fields(data.get('fields'))
+        .truncate(data.get('truncate'))
+    )
+    # The coordinates are the geometry of the features
+    if format == 'geojson':
+        projection.include('coordinates')
+
+    layout = data.get('layout', 'rows')
+    if layout not in ['rows', 'columns']:
+        raise ValueError('Layout must be one of [rows, columns]')
+    if layout == 'columns' and format != 'json':
+        raise ValueError('The layout columns can only be used for JSON')
+    return projection.build(), layout
 
 
 async def parse(
-    data: RequestParameters | dict[str, Any], uid: str | None
-) -> tuple[tuple[str | None, int], dict[str, Any], int, str]:
-    blocklist = None
+    data: RequestParameters | dict[str, Any], uid: int | None
+) -> tuple[
+    tuple[str | None, int], dict[str, Any], int, dict[int, dict] | None
+]:
+    # Fetch the personal lists of the user while the other parameters are parsed
+    personal = None
     if uid is not None:
-        blocklist = await Sanic.get_app().ctx.db.blocklist.distinct(
-            'note', {'user': uid}
+        personal = asyncio.ensure_future(
+            asyncio.gather(lists.blocklist(uid), lists.watchlist(uid))
         )
 
+    try:
+        # Determine how to handle entries on the watchlist in the final results
+        mode = data.get('watchlist', 'include')
+        if mode not in ['include', 'hide', 'only']:
+            raise ValueError('Watchlist must be one of [include, hide, only]')
+
+        # Do not allow watchlist queries except the default if the request is unauthenticated
+        if uid is None and mode != 'include':
+            raise ValueError(
+                'Can not search user-specific watchlist if unauthenticated'
+            )
+
+        # Parsing long expressions of users with the (pure Python) parser needs a lot of CPU time,
+        # so it is done in a thread where the event loop can still handle other requests in the meantime
+        started = time.perf_counter()
+        if (
+            size(data, 'author') + size(data, 'user')
+            >= Sanic.get_app().config.OFFLOAD_USERS_SIZE
+        ):
+            sort, filter, limit = await offload(conditions, data)
+        else:
+            sort, filter, limit = conditions(data)
+        metrics.record('parse', time.perf_counter() - started)
+    except ValueError:
+        if personal is not None:
+            personal.cancel()
+        raise
+
+    # The watchlist of the user is added to the results after they are fetched from the database
+    blocklist = None
+    watchlist = None
+    if personal is not None:
+        blocklist, watchlist = await personal
+
+    filter = filter.exclude(blocklist).watchlist(mode, watchlist).build()
+    return sort, filter, limit, watchlist
+
+
+# Build the sort criteria, the conditions and the limit of a search from its parameters
+def conditions(
+    data: RequestParameters | dict[str, Any],
+) -> tuple[tuple[str | None, int], Filter, int]:
     sort = (
         Sort()
         .by(data.get('sort_by'), 'updated_at')
@@ -200,7 +633,7 @@ async def parse(
     )
     filter = (
         Filter(sort)
-        .exclude(blocklist)
+        .cursor(data.get('cursor'))
         .query(data.get('query'), data.get('scope'))
         .bbox(data.get('bbox'))
         .polygon(data.get('polygon'))
@@ -212,7 +645,6 @@ async def parse(
         .before(data.get('before'))
         .comments(data.get('comments'))
         .commented(data.get('commented'))
-        .build()
     )
     limit = (
         Limit(data.get('limit'))
@@ -221,18 +653,14 @@ async def parse(
         .build()
     )
 
-    # Determine how to handle entries on the watchlist in the final results
-    watchlist = data.get('watchlist', 'include')
-    if watchlist not in ['include', 'hide', 'only']:
-        raise ValueError('Watchlist must be one of [include, hide, only]')
+    if sort[0] == 'relevance' and '$text' not in filter.build():
+        raise ValueError('Sorting by relevance requires a query')
+    return sort, filter, limit
 
-    # Do not allow watchlist queries except the default if the request is unauthenticated
-    if uid is None and watchlist != 'include':
-        raise ValueError(
-            'Can not search user-specific watchlist if unauthenticated'
-        )
 
-    return sort, filter, limit, watchlist
+def size(data: RequestParameters | dict[str, Any], name: str) -> int:
+    value = data.get(name)
+    return 0 if value is None else len(str(value))
 
 
 # Define an aggregation pipeline to allow more complex queries than a call to find() can manage
@@ -240,10 +668,9 @@ def build(
     sort: tuple[str | None, int],
     filter: dict[str, Any],
     limit: int,
-    watchlist: str,
-    uid: int | None,
+    projection: list[dict[str, Any]],
 ) -> tuple[AsyncCollection, list[dict[str, Any]]]:
-    # Default collection which will be used by nearly all queries
+    # All queries (including the ones for the watchlist) are done on the notes collection
     collection: AsyncCollection = Sanic.get_app().ctx.db.notes
 
     pipeline: list[dict[str, Any]] = [
@@ -251,114 +678,254 @@ def build(
     ]
 
     # Queries are faster if the sorting is not explicitly specified (if desired)
-    if sort[0] is not None:
-        pipeline.append({'$sort': {sort[0]: sort[1]}})
+    if sort[0] == 'relevance':
+        pipeline.append({'$sort': {'score': {'$meta': 'textScore'}}})
+    elif sort[0] is not None:
+        # Sort by the id as well to have a well-defined order for notes with the same date,
+        # which is required to continue the search with a cursor
+        pipeline.append({'$sort': {sort[0]: sort[1], '_id': sort[1]}})
 
     # Apply the specified limit by adding a limit stage
     pipeline.append({'$limit': limit})
 
-    # If the query is done by an authenticated user, allow for additional search options regarding the watchlist
-    if uid is not None:
-        pipelineIncludeWatchlist = [
-            {
-                '$lookup': {
-                    'from': 'watchlist',
-                    'let': {'id': '$_id'},
-                    'pipeline': [
-                        {
-                            '$match': {
-                                '$expr': {
-                                    '$and': [
-                                        {'$eq': ['$note', '$$id']},
-                                        {'$eq': ['$user', uid]},
-                                    ]
-                                }
-                            }
-                        },
-                        {
-                            '$project': {
-                                '_id': 0,
-                                'comment': 1,
-                                'created_at': 1,
-                                'updated_at': 1,
-                            }
-                        },
-                    ],
-                    'as': 'watchlist',
-                }
-            },
-            {'$addFields': {'watchlist': {'$arrayElemAt': ['$watchlist', 0]}}},
-        ]
+    # Only return the requested fields
+    pipeline.extend(projection)
 
-        pipelineHideWatchlist = [
-            # Use a higher limit than allowed before the lookup operation
-            # to limit the set of potential candidates for the exclusion check.
-            # Do not use a hardcoded limit for this but instead calculate it from
-            # the total (allowed) amount of notes on the watchlist of the current user and the actual limit
-            {'$limit': Sanic.get_app().config.WATCHLIST_LIMIT + limit},
-            *pipelineIncludeWatchlist,
-            {
-                '$match': {
-                    'watchlist': {'$eq': None},
-                },
-            },
-        ]
+    return collection, pipeline
 
-        pipelineOnlyWatchlist = [
-            {
-                '$lookup': {
-                    'from': 'notes',
-                    'localField': 'note',
-                    'foreignField': '_id',
-                    'as': 'note',
-                }
-            },
-            {'$unwind': '$note'},
+
+async def find(
+    collection: AsyncCollection,
+    pipeline: list[dict[str, Any]],
+    options: dict[str, Any],
+    watchlist: dict[int, dict] | None,
+    sort: tuple[str | None, int],
+    limit: int,
+    layout: str,
+    format: str,
+) -> HTTPResponse:
+    started = time.perf_counter()
+    with metrics.span('aggregate'):
+        cursor = await collection.aggregate(pipeline, **options)
+    with metrics.span('iterate'):
+        result = []
+        async for document in cursor:
+            result.append(annotate(document, watchlist))
+        await cursor.close()
+    slow(collection, pipeline, options, time.perf_counter() - started)
+
+    # Only provide a cursor for the next page if there are potentially more results
+    headers = {}
+    if sort[0] not in [None, 'relevance'] and len(result) == limit:
+        headers['X-Cursor'] = Cursor.encode(sort, result[-1])
+
+    with metrics.span('serialize'):
+        body = await serialize(result, layout, format)
+    return HTTPResponse(
+        body, headers=headers, content_type=CONTENT_TYPES[format]
+    )
+
+
+# Serializing a lot of notes needs a lot of CPU time while holding the interpreter lock
+# (so a thread would not help), therefore the notes are serialized in chunks
+# and other requests can be handled by the event loop between two chunks.
+# The chunks are appended to a single buffer, since joining all of them at the end would block the event loop again
+async def serialize(result: list[dict], layout: str, format: str) -> bytearray:
+    size = Sanic.get_app().config.SERIALIZE_CHUNK_SIZE
+    body = bytearray()
+    if format == 'geojson':
+        body += b'{"type":"FeatureCollection","features":'
+        await array(body, features(result)['features'], size)
+        body += b'}'
+    elif format == 'msgpack':
+        await pack(body, result, size)
+    elif layout == 'columns':
+        body += b'{'
+        for i, (name, values) in enumerate(columns(result).items()):
+            body += b',' if i > 0 else b''
+            body += orjson.dumps(name) + b':'
+            await array(body, values, size)
+        body += b'}'
+    else:
+        await array(body, result, size)
+    return body
+
+
+async def array(body: bytearray, values: list, size: int) -> None:
+    body += b'['
+    for start in range(0, len(values), size):
+        if start > 0:
+            await asyncio.sleep(0)
+            body += b','
+        chunk = orjson.dumps(
+            values[start : start + size], option=orjson.OPT_NAIVE_UTC
+        )
+        # Remove the brackets of the array to join the elements of all chunks
+        body += memoryview(chunk)[1:-1]
+    body += b']'
+
+
+async def pack(body: bytearray, values: list, size: int) -> None:
+    packer = msgpack.Packer(default=encode)
+    body += packer.pack_array_header(len(values))
+    for start in range(0, len(values), size):
+        if start > 0:
+            await asyncio.sleep(0)
+        for value in values[start : start + size]:
+            body += packer.pack(value)
+
+
+# Dates are stored without a timezone in UTC, but MessagePack only supports dates with a timezone
+def encode(value: Any) -> Any:  # noqa: ANN401
+    if isinstance(value, datetime.datetime):
+        return msgpack.Timestamp.from_datetime(
+            value.replace(tzinfo=datetime.timezone.utc)
+        )
+    raise TypeError(f'Can not serialize {type(value)}')
+
+
+# Write every document to the response as soon as it is received from the database
+async def stream(
+    request: Request,
+    collection: AsyncCollection,
+    pipeline: list[dict[str, Any]],
+    options: dict[str, Any],
+    watchlist: dict[int, dict] | None,
+    headers: dict[str, str],
+) -> None:
+    started = time.perf_counter()
+    with metrics.span('aggregate'):
+        cursor = await collection.aggregate(
+            pipeline,
+            batchSize=Sanic.get_app().config.STREAM_BATCH_SIZE,
+            **options,
+        )
+    response = await request.respond(
+        headers=headers, content_type='application/x-ndjson'
+    )
+    # Make sure the cursor is also closed if the client disconnects early
+    try:
+        # The documents are sent while iterating, so a slow client also prolongs the iteration
+        with metrics.span('iterate'):
+            async for document in cursor:
+                await response.send(
+                    orjson.dumps(
+                        annotate(document, watchlist),
+                        option=orjson.OPT_NAIVE_UTC
+                        | orjson.OPT_APPEND_NEWLINE,
+                    )
+                )
+    finally:
+        await cursor.close()
+    await response.eof()
+    slow(collection, pipeline, options, time.perf_counter() - started)
+
+
+# Explain how the database executes the search to verify the choice of the index
+async def explain(
+    collection: AsyncCollection,
+    pipeline: list[dict[str, Any]],
+    shape: str,
+    options: dict[str, Any],
+) -> HTTPResponse:
+    return raw(
+        json_util.dumps(
             {
-                '$replaceRoot': {
-                    'newRoot': {
-                        '$mergeObjects': [
-                            '$note',
-                            {
-                                'watchlist': {
-                                    'comment': '$comment',
-                                    'created_at': '$created_at',
-                                    'updated_at': '$updated_at',
-                                },
-                            },
-                        ]
-                    }
-                }
-            },
-            {'$match': filter},
-        ]
+                'shape': shape,
+                'hint': options.get('hint'),
+                'plan': await plan(collection, pipeline, options),
+            }
+        ),
+        content_type='application/json',
+    )
 
-        if watchlist == 'include':
-            # In the default case, only add a lookup pipeline at the end to include the information from the entries on the watchlist
-            pipeline.extend(pipelineIncludeWatchlist)
-        elif watchlist == 'hide':
-            # Use a different pipeline to hide notes that are on the watchlist from the results
-            pipeline[2:2] = pipelineHideWatchlist
-        elif watchlist == 'only':
-            # Use another pipeline to only show notes on the personal watchlist
-            collection = Sanic.get_app().ctx.db.watchlist
 
-            # Replace the original filter with a simple filter for the current uid,
-            # because this search is performed against the watchlist collection,
-            # however the original filter is still added at the end of this pipeline
-            pipeline[0]['$match'] = {'user': uid}
+async def plan(
+    collection: AsyncCollection,
+    pipeline: list[dict[str, Any]],
+    options: dict[str, Any],
+) -> dict[str, Any]:
+    return await Sanic.get_app().ctx.db.command(
+        {
+            'aggregate': collection.name,
+            'pipeline': pipeline,
+            'explain': True,
+            **options,
+        }
+    )
 
-            pipeline[1:1] = pipelineOnlyWatchlist
 
-    return collection, pipeline
+# Log searches which took longer than the configured threshold together with their query plan,
+# which is explained in the background so that the response is not delayed any further
+def slow(
+    collection: AsyncCollection,
+    pipeline: list[dict[str, Any]],
+    options: dict[str, Any],
+    duration: float,
+) -> None:
+    app = Sanic.get_app()
+    threshold = app.config.SLOW_QUERY_THRESHOLD
+    if threshold is None or duration < threshold:
+        return
 
+    async def log() -> None:
+        try:
+            summary = metrics.summarize(
+                await plan(collection, pipeline, options)
+            )
+        except PyMongoError as error:
+            summary = f'Could not explain the search: {error}'
+        logger.warning(
+            f'Slow search ({duration:.3f}s): {json_util.dumps(pipeline)} {options} {summary}'
+        )
 
-async def find(
-    collection: AsyncCollection, pipeline: list[dict[str, Any]]
-) -> JSONResponse:
-    cursor = await collection.aggregate(pipeline)
-    result = []
-    async for document in cursor:
-        result.append(document)
-    await cursor.close()
-    return json(result, dumps=orjson.dumps, option=orjson.OPT_NAIVE_UTC)
+    app.add_task(log())
+
+
+# Arrange the notes as an array for each field instead of an array of notes,
+# which is smaller since the names of the fields are not repeated for every note
+def columns(notes: list[dict]) -> dict[str, list]:
+    names = []
+    for note in notes:
+        for name in note:
+            if name not in names:
+                names.append(name)
+
+    table = {}
+    for name in names:
+        if name == 'coordinates':
+            table['longitude'] = [note[name][0] for note in notes]
+            table['latitude'] = [note[name][1] for note in notes]
+        else:
+            table[name] = [note.get(name) for note in notes]
+    return table
+
+
+# Convert the notes to a GeoJSON feature collection, which can be displayed directly by most maps
+def features(notes: list[dict]) -> dict[str, Any]:
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'id': note['_id'],
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': note['coordinates'],
+                },
+                'properties': {
+                    key: value
+                    for key, value in note.items()
+                    if key != 'coordinates'
+                },
+            }
+            for note in notes
+        ],
+    }
+
+
+# Add the information of the entry on the personal watchlist to a note
+def annotate(document: dict, watchlist: dict[int, dict] | None) -> dict:
+    if watchlist is not None and document['_id'] in watchlist:
+        document['watchlist'] = watchlist[document['_id']]
+    return document
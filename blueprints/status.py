@@ -1,10 +1,12 @@
-import os
+from email.utils import formatdate
 
 from sanic import Blueprint, Sanic
 from sanic.request import Request
-from sanic.response import JSONResponse, json
+from sanic.response import HTTPResponse, empty, json
 from sanic_ext import openapi
 
+from api.http import matches
+
 blueprint = Blueprint('Status', url_prefix='/status')
 
 
@@ -21,30 +23,32 @@ blueprint = Blueprint('Status', url_prefix='/status')
                 'last_import': openapi.DateTime(),
                 'last_sync': openapi.DateTime(),
                 'last_update': openapi.DateTime(),
+                'notes': openapi.Integer(
+                    description='Estimated amount of notes in the database'
+                ),
+                'update_lag': openapi.Integer(
+                    description='Seconds since the last update of the notes'
+                ),
             }
         ),
     },
     'The response is an object with the currently available status information',
 )
-async def status(request: Request) -> JSONResponse:
-    last_import = None
-    last_sync = None
-    last_update = None
-
-    root = Sanic.get_app().config.ROOT_PATH
-    with (
-        open(os.path.join(root, 'scripts', 'LAST_IMPORT.txt')) as file1,
-        open(os.path.join(root, 'scripts', 'LAST_SYNC.txt')) as file2,
-        open(os.path.join(root, 'scripts', 'LAST_UPDATE.txt')) as file3,
-    ):
-        last_import = file1.read().strip()
-        last_sync = file2.read().strip()
-        last_update = file3.read().strip()
+@openapi.response(
+    304,
+    description='The status did not change since the last request',
+)
+async def status(request: Request) -> HTTPResponse:
+    # The information is refreshed in the background, see api.status.refresh_status
+    summary = Sanic.get_app().ctx.summary
+    headers = {
+        # The ETag is weak, since the lag is still updated without changing it
+        'ETag': f'W/"{summary["etag"]}"',
+        'Cache-Control': f'public, max-age={Sanic.get_app().config.STATUS_INTERVAL}',
+    }
+    if summary['modified'] is not None:
+        headers['Last-Modified'] = formatdate(summary['modified'], usegmt=True)
 
-    return json(
-        {
-            'last_import': last_import,
-            'last_sync': last_sync,
-            'last_update': last_update,
-        }
-    )
+    if matches(request, headers['ETag']):
+        return empty(304, headers=headers)
+    return json(summary['values'], headers=headers)
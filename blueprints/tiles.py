@@ -0,0 +1,253 @@
+import asyncio
+import os
+from textwrap import dedent
+from typing import Any
+
+import msgpack
+import orjson
+from sanic import Blueprint, Sanic
+from sanic.request import Request
+from sanic.response import HTTPResponse, empty, json, raw
+from sanic_ext import openapi
+
+from api import planner, tiles
+from api.http import matches
+from api.query import Projection
+from blueprints.search import (
+    accepts_msgpack,
+    build,
+    encode,
+    features,
+    fingerprint,
+    parse,
+)
+from config import Config
+
+blueprint = Blueprint('Tiles', url_prefix='/tiles')
+config = Config()
+
+
+@blueprint.route('/open/<z:int>/<x:int>/<y:int>')
+@openapi.summary('Tiles of open notes')
+@openapi.description(
+    dedent(
+        """\
+        Get the open notes within a tile of the map as a GeoJSON feature collection.
+        These tiles are rendered in advance whenever the notes change, so they are faster than the tiles which can be filtered.
+        """
+    )
+)
+@openapi.parameter(
+    'z',
+    openapi.Integer(minimum=config.TILE_CACHE_ZOOM, maximum=config.MAX_ZOOM),
+    location='path',
+)
+@openapi.parameter('x', openapi.Integer(minimum=0), location='path')
+@openapi.parameter('y', openapi.Integer(minimum=0), location='path')
+@openapi.response(
+    200,
+    {'application/geo+json': openapi.Object()},
+    'The response is a GeoJSON feature collection containing the open notes of the tile',
+)
+@openapi.response(
+    400,
+    {
+        'application/json': openapi.Object(
+            properties={'error': openapi.String()}
+        )
+    },
+    'In case the tile does not exist, the response contains the error message',
+)
+@openapi.response(
+    304,
+    description='The tile did not change since the last request',
+)
+async def rendered(request: Request, z: int, x: int, y: int) -> HTTPResponse:
+    app = Sanic.get_app()
+    zoom = app.config.TILE_CACHE_ZOOM
+    if z < zoom or z > app.config.MAX_ZOOM:
+        return json(
+            {
+                'error': f'Zoom must be between {zoom} and {app.config.MAX_ZOOM}'
+            },
+            status=400,
+        )
+    if x >= 2**z or y >= 2**z:
+        return json({'error': 'The tile does not exist'}, status=400)
+
+    # Tiles of higher zoom levels are part of a rendered tile
+    shift = z - zoom
+    path = os.path.join(
+        app.config.TILE_CACHE_PATH,
+        str(zoom),
+        str(x >> shift),
+        f'{y >> shift}.geojson',
+    )
+    # Tiles without any open notes are not stored at all
+    try:
+        stat = await asyncio.to_thread(os.stat, path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    except FileNotFoundError:
+        path = None
+        etag = '"empty"'
+
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={app.config.TILE_MAX_AGE}',
+    }
+    if matches(request, etag):
+        return empty(304, headers=headers)
+
+    body = None if path is None else await asyncio.to_thread(read, path)
+    if body is None:
+        collection = {'type': 'FeatureCollection', 'features': []}
+        return json(
+            collection, headers=headers, content_type='application/geo+json'
+        )
+    if shift > 0:
+        body = orjson.dumps(tiles.clip(orjson.loads(body), z, x, y))
+    return raw(body, headers=headers, content_type='application/geo+json')
+
+
+# Read a rendered tile, which might have been removed in the meantime
+def read(path: str) -> bytes | None:
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+@blueprint.route('/<z:int>/<x:int>/<y:int>')
+@openapi.summary('Tiles')
+@openapi.description(
+    dedent(
+        """\
+        Get the notes within a tile of the map as a GeoJSON feature collection.
+        The same filters as for a search can be used, except the ones for the region, limiting and paginating the results.
+        Since the tiles are the same for everyone, they can be cached by the client and any proxy until they expire.
+        For lower zoom levels the clusters of notes should be used instead.
+        """
+    )
+)
+@openapi.parameter(
+    'z',
+    openapi.Integer(minimum=config.TILE_MIN_ZOOM, maximum=config.MAX_ZOOM),
+    location='path',
+)
+@openapi.parameter('x', openapi.Integer(minimum=0), location='path')
+@openapi.parameter('y', openapi.Integer(minimum=0), location='path')
+@openapi.parameter(
+    'view',
+    openapi.String(
+        description='A predefined set of fields which are returned for each note',
+        enum=tuple(Projection.VIEWS),
+        default='summary',
+    ),
+)
+@openapi.parameter(
+    'format',
+    openapi.String(
+        description='Encode the feature collection as GeoJSON or as MessagePack, which is more compact',
+        enum=('geojson', 'msgpack'),
+        default='geojson',
+    ),
+)
+@openapi.response(
+    200,
+    {
+        'application/geo+json': openapi.Object(),
+        'application/msgpack': openapi.Object(),
+    },
+    'The response is a GeoJSON feature collection containing the notes of the tile, which is encoded as MessagePack if `format` is `msgpack` or the `Accept` header contains `application/msgpack`',
+)
+@openapi.response(
+    400,
+    {
+        'application/json': openapi.Object(
+            properties={'error': openapi.String()}
+        )
+    },
+    'In case one of the parameters is invalid, the response contains the error message',
+)
+@openapi.response(
+    304,
+    description='The tile did not change since the last request',
+)
+async def tile(request: Request, z: int, x: int, y: int) -> HTTPResponse:
+    app = Sanic.get_app()
+    try:
+        if z < app.config.TILE_MIN_ZOOM or z > app.config.MAX_ZOOM:
+            raise ValueError(
+                f'Zoom must be between {app.config.TILE_MIN_ZOOM} and {app.config.MAX_ZOOM}'
+            )
+        if x >= 2**z or y >= 2**z:
+            raise ValueError('The tile does not exist')
+
+        args = {key: request.args.get(key) for key in request.args}
+        format = args.pop('format', None)
+        if format is None:
+            format = 'msgpack' if accepts_msgpack(request) else 'geojson'
+        if format not in ['geojson', 'msgpack']:
+            raise ValueError('Format must be one of [geojson, msgpack]')
+        if 'bbox' in args or 'polygon' in args:
+            raise ValueError('The region of a tile can not be changed')
+        west, south, east, north = tiles.bounds(z, x, y)
+        args['bbox'] = f'{west},{south},{east},{north}'
+
+        # Tiles are the same for everyone, so the personal lists of the user are not used
+        sort, filter, _, _ = await parse(args, None)
+        projection = (
+            Projection(sort)
+            .view(args.get('view', 'summary'))
+            .truncate(args.get('truncate'))
+            .build()
+        )
+    except ValueError as error:
+        return json({'error': str(error)}, status=400)
+
+    collection, pipeline = build(
+        sort, filter, app.config.TILE_LIMIT, projection
+    )
+    _, hint = planner.plan(
+        sort,
+        filter,
+        app.config.QUERY_HINTS,
+        app.config.GEO_SELECTIVE_AREA,
+        app.ctx.indices,
+    )
+    options: dict[str, Any] = {} if hint is None else {'hint': hint}
+
+    key = fingerprint('tiles', z, x, y, sort, filter, projection, format)
+    headers = {
+        'ETag': f'W/"{key}"',
+        'Cache-Control': f'public, max-age={app.config.TILE_MAX_AGE}',
+        # The format can also be chosen by the accepted content types
+        'Vary': 'Accept',
+    }
+    if matches(request, headers['ETag']):
+        return empty(304, headers=headers)
+
+    cached = app.ctx.responses.get(key)
+    if cached is not None:
+        body, _, content_type = cached
+        return raw(body, headers=headers, content_type=content_type)
+
+    cursor = await collection.aggregate(pipeline, **options)
+    result = await cursor.to_list()
+    if format == 'msgpack':
+        response = raw(
+            msgpack.packb(features(result), default=encode),
+            headers=headers,
+            content_type='application/msgpack',
+        )
+    else:
+        response = json(
+            features(result),
+            headers=headers,
+            content_type='application/geo+json',
+            dumps=orjson.dumps,
+            option=orjson.OPT_NAIVE_UTC,
+        )
+    app.ctx.responses.set(key, (response.body, {}, response.content_type))
+    return response
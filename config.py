@@ -22,6 +22,78 @@ class Config:
     MAX_LIMIT: int = 500
     BLOCKLIST_LIMIT: int = 500
     WATCHLIST_LIMIT: int = 500
+    # Highest zoom level of the map for which clusters can be requested,
+    # the tiles used for clustering are 2^CLUSTER_DETAIL times smaller than the tiles of the map
+    MAX_ZOOM: int = 20
+    CLUSTER_DETAIL: int = 3
+    MAX_CLUSTERS: int = 10000
+    # Highest zoom level of the tiles whose notes are counted in advance by scripts/tiles.py (at most TILE_CACHE_ZOOM),
+    # the clusters of lower zoom levels are combined from these counts instead of grouping the notes
+    CLUSTER_COUNT_ZOOM: int = 10
+    # Amount of tiles of the map (in each direction) the region of clusters can span at most
+    # if the notes need to be grouped, so that the notes of the whole world are never grouped at once
+    CLUSTER_MAX_SPAN: int = 8
+    # Lowest zoom level of the tiles containing notes, their maximum amount of notes
+    # and the time (in seconds) they can be cached by clients and proxies
+    TILE_MIN_ZOOM: int = 10
+    TILE_LIMIT: int = 1000
+    TILE_MAX_AGE: int = 60
+    # Zoom level and location of the tiles containing all open notes, which are rendered by scripts/tiles.py
+    TILE_CACHE_ZOOM: int = 12
+    TILE_CACHE_PATH: str = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tiles')
+    # Amount of changed notes waiting to be sent to a client of the live feed,
+    # the seconds between two messages keeping the connection open
+    # and the seconds to wait before reading the changes again after an error
+    FEED_QUEUE_SIZE: int = 1000
+    FEED_KEEPALIVE: int = 15
+    FEED_RETRY_INTERVAL: int = 10
+    # Amount of threads of each worker used for parsing long expressions of users (with at least the given length),
+    # which only helps since the parser is written in Python (functions written in C keep the interpreter lock)
+    EXECUTOR_WORKERS: int = 4
+    OFFLOAD_USERS_SIZE: int = 100
+    # Amount of notes which are serialized at once before other requests can be handled
+    SERIALIZE_CHUNK_SIZE: int = 100
+    # Amount of documents fetched at once from the database when streaming results
+    STREAM_BATCH_SIZE: int = 50
+
+    # Amount and lifetime (in seconds) of cached responses of anonymous searches
+    SEARCH_CACHE_SIZE: int = 200
+    SEARCH_CACHE_TTL: int = 600
+    # Amount and lifetime (in seconds) of cached watchlists and blocklists of users
+    LIST_CACHE_SIZE: int = 1000
+    LIST_CACHE_TTL: int = 600
+    # Number of slots used to invalidate cached data of users in all workers
+    INVALIDATION_SLOTS: int = 65536
+
+    # Seconds between two checks whether the notes were updated
+    STATUS_INTERVAL: int = 10
+
+    # Indices used for each shape of a search (see api.planner), the first existing one is used as a hint,
+    # the database chooses the index on its own if none of them exists (or none is given)
+    QUERY_HINTS: dict[str, list[str]] = field(default_factory=lambda: {
+        'text': [],
+        'ids': ['_id_'],
+        'author': ['author'],
+        'user': ['user'],
+        'geo': ['coordinates'],
+        'comment_count': ['comment_count'],
+        'updated_at': ['updated_at'],
+        'created_at': ['created_at'],
+        'status_updated_at': ['status_updated_at'],
+        'status_created_at': ['status_created_at'],
+        # The partial indices are only used if they were created (see scripts/indices.py --partial)
+        'open_updated_at': ['open_updated_at', 'status_updated_at'],
+        'open_created_at': ['open_created_at', 'status_created_at'],
+        'none': [],
+    })
+    # Maximum area (in square degrees) of a region to be considered more selective than other conditions
+    GEO_SELECTIVE_AREA: float = 1.0
+    # Allow to explain the query plan of a search
+    SEARCH_EXPLAIN: bool = False
+    # Seconds after which a search is logged together with its query plan, None disables the logging
+    SLOW_QUERY_THRESHOLD: float | None = 1.0
+    # Token which needs to be sent as a bearer token to read the metrics, None makes them public
+    METRICS_TOKEN: str | None = os.environ.get('METRICS_TOKEN')
 
     ROOT_PATH: str = os.path.dirname(os.path.realpath(__file__))
 
@@ -31,9 +103,16 @@ class Config:
 
     OPENSTREETMAP_OAUTH_JWKS_URI: str = env('OPENSTREETMAP_OAUTH_JWKS_URI')
     OPENSTREETMAP_OAUTH_CLIENT_ID: str = env('OPENSTREETMAP_OAUTH_CLIENT_ID')
+    # Seconds between two refreshes of the signing keys
+    JWKS_REFRESH_INTERVAL: int = 3600
+
+    # Amount and lifetime (in seconds) of verified tokens kept in memory
+    TOKEN_CACHE_SIZE: int = 10000
+    TOKEN_CACHE_TTL: int = 300
 
     CORS_ORIGINS: str = '*'
     CORS_ALLOW_HEADERS: list[str] = field(default_factory=lambda: ['Authorization', 'Content-Type'])
+    CORS_EXPOSE_HEADERS: list[str] = field(default_factory=lambda: ['X-Cursor'])
     CORS_ALWAYS_SEND: bool = False
     # fmt: on
 
@@ -0,0 +1,376 @@
+import argparse
+import concurrent.futures
+import datetime
+import math
+import os
+import random
+import subprocess
+import sys
+import textwrap
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+import requests
+from tqdm import tqdm
+
+DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+
+# The first notes were created at this date
+START = datetime.datetime(2013, 4, 23, tzinfo=datetime.timezone.utc)
+# Centers (longitude, latitude) and spread (in degrees) of the regions where most notes are located,
+# the remaining notes are spread over the whole world
+REGIONS = [
+    (13.40, 52.52, 1.5),
+    (2.35, 48.86, 1.5),
+    (-0.13, 51.51, 1.0),
+    (-74.00, 40.71, 1.0),
+    (-122.42, 37.77, 1.0),
+    (139.69, 35.69, 1.0),
+    (77.21, 28.61, 2.0),
+    (-46.63, -23.55, 2.0),
+    (18.42, -33.92, 1.0),
+    (151.21, -33.87, 1.0),
+]
+BACKGROUND = 0.2
+# Share of notes which were created anonymously
+ANONYMOUS = 0.3
+WORDS = (
+    'road bridge missing building shop closed name wrong street house number '
+    'path footway track river park school church restaurant cafe bus stop '
+    'station parking entrance gate fence wall tree forest field farm lake '
+    'construction demolished opened moved address postcode village town '
+    'city hospital pharmacy bank toilet bench playground crossing traffic '
+    'signals speed limit oneway turn restriction survey imagery outdated'
+).split()
+
+# Parameters of the searches which are replayed against the API by their name,
+# the placeholders are replaced with random values of the synthetic notes
+SHAPES = {
+    'recent': {},
+    'open': {'status': 'open'},
+    'bbox': {'bbox': '{bbox}'},
+    'bbox_open': {'bbox': '{bbox}', 'status': 'open'},
+    'text': {'query': '{word}', 'scope': 'all'},
+    'phrase': {'query': '"{word} {word}"'},
+    'author': {'author': '{user}'},
+    'user': {'user': '{user}', 'sort_by': 'created_at'},
+    'comments': {'comments': '2-', 'status': 'open'},
+    # The searches using the watchlist require a token of a user who logged in before
+    'watchlist_hide': {'watchlist': 'hide'},
+    'watchlist_only': {'watchlist': 'only'},
+}
+AUTHENTICATED = ['watchlist_hide', 'watchlist_only']
+
+
+# Generates random (but reproducible) notes, whose users, words and locations are also used for the searches
+class Corpus(object):
+    def __init__(self, seed: int, users: int = 5000) -> None:
+        self.random = random.Random(seed)
+        self.users = [(i + 1, f'mapper_{i + 1}') for i in range(users)]
+        # A few users write most of the comments
+        self.weights = [1 / (i + 1) for i in range(users)]
+
+    def user(self) -> tuple[int, str]:
+        return self.random.choices(self.users, self.weights)[0]
+
+    def word(self) -> str:
+        return self.random.choice(WORDS)
+
+    def location(self) -> tuple[float, float]:
+        if self.random.random() < BACKGROUND:
+            # Uniformly distributed on the sphere instead of the map
+            return (
+                self.random.uniform(-180, 180),
+                math.degrees(math.asin(self.random.uniform(-0.99, 0.99))),
+            )
+        longitude, latitude, spread = self.random.choice(REGIONS)
+        return (
+            max(min(self.random.gauss(longitude, spread), 180), -180),
+            max(min(self.random.gauss(latitude, spread), 85), -85),
+        )
+
+    # Most comments are short, but some of them are very long
+    def text(self) -> str:
+        length = max(1, round(self.random.lognormvariate(2.3, 0.9)))
+        return ' '.join(self.word() for _ in range(length))
+
+    def bbox(self) -> str:
+        longitude, latitude = self.location()
+        size = self.random.choice([0.05, 0.2, 1.0])
+        return ','.join(
+            f'{value:.4f}'
+            for value in (
+                max(longitude - size, -180),
+                max(latitude - size, -90),
+                min(longitude + size, 180),
+                min(latitude + size, 90),
+            )
+        )
+
+    # Create a note in the format of the notes dump
+    def note(self, id: int, now: datetime.datetime) -> str:
+        longitude, latitude = self.location()
+        created_at = START + (now - START) * self.random.random() ** 0.5
+        # Most notes are closed after a few comments, some of them are reopened again
+        actions = ['opened']
+        while (
+            self.random.random() < (0.8 if len(actions) == 1 else 0.35)
+            and len(actions) < 50
+        ):
+            if actions[-1] == 'closed':
+                actions.append('reopened')
+            elif self.random.random() < 0.85:
+                actions.append('closed')
+            else:
+                actions.append('commented')
+
+        comments = []
+        date = created_at
+        for i, action in enumerate(actions):
+            if i > 0:
+                delay = self.random.expovariate(1 / 500)
+                date = min(date + datetime.timedelta(hours=delay), now)
+            attributes = f'action="{action}" timestamp="{iso(date)}"'
+            if i > 0 or self.random.random() > ANONYMOUS:
+                uid, name = self.user()
+                attributes += f' uid="{uid}" user={quoteattr(name)}'
+            # Notes are often closed without a comment
+            if action == 'closed' and self.random.random() < 0.5:
+                comments.append(f'<comment {attributes}/>')
+            else:
+                text = escape(self.text())
+                comments.append(f'<comment {attributes}>{text}</comment>')
+
+        attributes = f'id="{id}" lat="{latitude:.7f}" lon="{longitude:.7f}" created_at="{iso(created_at)}"'
+        if actions[-1] == 'closed':
+            attributes += f' closed_at="{iso(date)}"'
+        return f'<note {attributes}>{"".join(comments)}</note>\n'
+
+
+def iso(date: datetime.datetime) -> str:
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# Write a notes dump containing the given amount of synthetic notes
+def generate(file: str, notes: int, seed: int) -> None:
+    corpus = Corpus(seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm-notes>\n')
+        for id in tqdm(range(1, notes + 1)):
+            f.write(corpus.note(id, now))
+        f.write('</osm-notes>\n')
+
+
+# Measure the throughput of the import script by importing the given notes dump,
+# all options are passed to the import script
+def benchmark_import(file: str, options: list[str]) -> None:
+    with open(file, 'rb') as f:
+        notes = sum(
+            chunk.count(b'<note ')
+            for chunk in iter(lambda: f.read(1024 * 1024), b'')
+        )
+
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(DIRECTORY, 'import.py'), file, *options],
+        check=True,
+    )
+    duration = time.perf_counter() - start
+    print(
+        textwrap.dedent(
+            f"""
+            ----------------------------------------
+            IMPORT BENCHMARK
+            --------------------
+            Imported {notes} notes in {duration:.1f} seconds
+            Throughput: {notes / duration:.0f} notes per second
+            ----------------------------------------
+            """
+        )
+    )
+
+
+# Send the searches to the API in random order and report the latency of each shape of a search
+def benchmark_search(
+    url: str,
+    shapes: list[str],
+    amount: int,
+    concurrency: int,
+    seed: int,
+    token: str | None,
+) -> None:
+    corpus = Corpus(seed)
+    if token is None:
+        shapes = [shape for shape in shapes if shape not in AUTHENTICATED]
+    searches = [
+        (shape, fill(SHAPES[shape], corpus))
+        for shape in corpus.random.choices(shapes, k=amount)
+    ]
+
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'notesreview-api benchmark'})
+    if token is not None:
+        session.headers.update({'Authorization': f'Bearer {token}'})
+
+    def search(parameters: dict[str, str]) -> tuple[float, bool]:
+        start = time.perf_counter()
+        try:
+            response = session.get(f'{url}/search', params=parameters)
+            success = response.status_code == 200
+        except requests.RequestException:
+            success = False
+        return time.perf_counter() - start, success
+
+    durations: dict[str, list[float]] = {shape: [] for shape in shapes}
+    errors = dict.fromkeys(shapes, 0)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = {
+            executor.submit(search, parameters): shape
+            for shape, parameters in searches
+        }
+        for future in tqdm(
+            concurrent.futures.as_completed(futures), total=len(futures)
+        ):
+            duration, success = future.result()
+            durations[futures[future]].append(duration)
+            if not success:
+                errors[futures[future]] += 1
+    total = time.perf_counter() - start
+
+    print(
+        f'\n{"shape":<16}{"requests":>10}{"errors":>8}'
+        f'{"p50 (ms)":>10}{"p95 (ms)":>10}{"p99 (ms)":>10}'
+    )
+    for shape in shapes:
+        values = sorted(durations[shape])
+        if len(values) == 0:
+            continue
+        print(
+            f'{shape:<16}{len(values):>10}{errors[shape]:>8}'
+            + ''.join(
+                f'{percentile(values, p) * 1000:>10.1f}' for p in (50, 95, 99)
+            )
+        )
+    print(
+        f'\n{len(searches)} searches in {total:.1f} seconds '
+        f'({len(searches) / total:.1f} searches per second)'
+    )
+
+
+# Replace the placeholders of the parameters with random values
+def fill(parameters: dict[str, str], corpus: Corpus) -> dict[str, str]:
+    filled = {}
+    for key, value in parameters.items():
+        while '{' in value:
+            value = (
+                value.replace('{bbox}', corpus.bbox(), 1)
+                .replace('{word}', corpus.word(), 1)
+                .replace('{user}', corpus.user()[1], 1)
+            )
+        filled[key] = value
+    return filled
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values: list[float], p: float) -> float:
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the import of notes and the searches of the API with synthetic notes.'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generation = commands.add_parser(
+        'generate', help='write a notes dump containing synthetic notes'
+    )
+    generation.add_argument('file', type=str, help='path of the notes dump')
+    generation.add_argument(
+        '-n',
+        '--notes',
+        type=int,
+        default=100000,
+        help='set the amount of notes (default: 100000)',
+    )
+    generation.add_argument(
+        '-s',
+        '--seed',
+        type=int,
+        default=0,
+        help='set the seed of the random values (default: 0)',
+    )
+
+    importing = commands.add_parser(
+        'import',
+        help='measure the throughput of importing a notes dump, other arguments are passed to import.py',
+    )
+    importing.add_argument('file', type=str, help='path of the notes dump')
+
+    searching = commands.add_parser(
+        'search', help='measure the latency of searches of a running API'
+    )
+    searching.add_argument(
+        '-u',
+        '--url',
+        type=str,
+        default='http://127.0.0.1:8000',
+        help='set the URL of the API (default: http://127.0.0.1:8000)',
+    )
+    searching.add_argument(
+        '--shapes',
+        type=str,
+        default=','.join(SHAPES),
+        help=f'set the shapes of the searches separated by a comma (default: {",".join(SHAPES)})',
+    )
+    searching.add_argument(
+        '-n',
+        '--requests',
+        type=int,
+        default=1000,
+        help='set the amount of searches (default: 1000)',
+    )
+    searching.add_argument(
+        '-c',
+        '--concurrency',
+        type=int,
+        default=8,
+        help='set the amount of concurrent searches (default: 8)',
+    )
+    searching.add_argument(
+        '-s',
+        '--seed',
+        type=int,
+        default=0,
+        help='set the seed used to generate the notes (default: 0)',
+    )
+    searching.add_argument(
+        '-t',
+        '--token',
+        type=str,
+        default=None,
+        help='set the token of a user to also search the watchlist',
+    )
+
+    args, options = parser.parse_known_args()
+    if args.command == 'import':
+        benchmark_import(args.file, options)
+    elif len(options) > 0:
+        parser.error(f'unrecognized arguments: {" ".join(options)}')
+    elif args.command == 'generate':
+        generate(args.file, args.notes, args.seed)
+    else:
+        shapes = args.shapes.split(',')
+        unknown = [shape for shape in shapes if shape not in SHAPES]
+        if len(unknown) > 0:
+            parser.error(f'unknown shapes: {", ".join(unknown)}')
+        benchmark_search(
+            args.url,
+            shapes,
+            args.requests,
+            args.concurrency,
+            args.seed,
+            args.token,
+        )
@@ -1,10 +1,13 @@
 import argparse
+import array
 import os
 
 import iteration
+import status
+import tiles
 from dotenv import load_dotenv
 from lxml import etree
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
 from tqdm import tqdm
 
 load_dotenv()
@@ -18,58 +21,99 @@ collection = client.notesreview.notes
 DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 
 
-# Find all ids of the notes which are included in the current notes dump
-def ids(file: str) -> tuple[set[int], int]:
-    ids = set()
-    last_id = 0
+# Find all ids of the notes which are included in the current notes dump,
+# which are stored in a compact array of 64-bit integers instead of a set of objects
+# (the last id is None if the dump does not contain any notes, e.g. because it is truncated)
+def ids(file: str) -> tuple[array.array, int | None]:
+    ids = array.array('q')
+    ordered = True
 
     def process_element(element: etree.Element) -> None:
-        nonlocal last_id
+        nonlocal ordered
 
         attributes = element.attrib
         id = int(attributes['id'])
-        last_id = id
-        ids.add(id)
+        if len(ids) > 0 and id < ids[-1]:
+            ordered = False
+        ids.append(id)
 
     iteration.fast_iter(
         tqdm(etree.iterparse(file, tag='note', events=('end',))),
         process_element,
     )
-    return ids, last_id
 
+    # The notes in the dump are usually already sorted by their id
+    if not ordered:
+        ids = array.array('q', sorted(ids))
+    return ids, ids[-1] if len(ids) > 0 else None
 
-# Delete (or only print the ids of) all notes that are stored in the database but not included in the set of ids
-def delete(ids_in_dump: set[int], last_id: int, delete: bool) -> None:
-    ids_in_db = set()
-    # Iterate over all documents with an id lower than the last id of the notes dump
+
+# Delete (or only print the ids of) all notes that are stored in the database but not included in the dump
+def delete(
+    ids_in_dump: array.array, last_id: int, delete: bool, chunk_size: int
+) -> None:
+    # Notes that are in the database but not in the dump
+    ids_in_db = array.array('q')
+    # Notes that are in the dump but not in the database
+    missing = array.array('q')
+
+    # Iterate over all documents with an id lower than the last id of the notes dump in the same order as the ids of the dump,
+    # so that both can be compared by advancing through them at the same time
+    position = 0
     for note in tqdm(
-        collection.find({}, {'_id': True}).max([('_id', last_id)]).hint('_id_')
+        collection.find({}, {'_id': True})
+        .sort('_id', ASCENDING)
+        .max([('_id', last_id)])
+        .hint('_id_')
     ):
-        if note['_id'] not in ids_in_dump:
-            # Add the id to the set if the note is in the database but not the dump
-            ids_in_db.add(note['_id'])
-            tqdm.write(str(note['_id']))
+        id = note['_id']
+        while position < len(ids_in_dump) and ids_in_dump[position] < id:
+            missing.append(ids_in_dump[position])
+            position += 1
+
+        if position < len(ids_in_dump) and ids_in_dump[position] == id:
+            position += 1
         else:
-            # Remove the id if the note is in the database and the dump
-            ids_in_dump.remove(note['_id'])
+            ids_in_db.append(id)
+            tqdm.write(str(id))
+
+    # The last id itself is not included in the iteration
+    while position < len(ids_in_dump) and ids_in_dump[position] < last_id:
+        missing.append(ids_in_dump[position])
+        position += 1
 
-    # ids_in_dump(_but_not_in_db) contains all notes that are in the dump but not in the database,
-    # ids_in_db(_but_not_in_dump) contains all notes that are in the database but not in the dump
     tqdm.write(
-        f'There are currently {len(ids_in_dump)} notes that are in the dump but not in the database: {list(ids_in_dump)[0:5]}...'
+        f'There are currently {len(missing)} notes that are in the dump but not in the database: {missing[0:5].tolist()}...'
     )
     tqdm.write(
-        f'There are currently {len(ids_in_db)} notes that are in the database but not in the dump: {list(ids_in_db)[0:5]}...'
+        f'There are currently {len(ids_in_db)} notes that are in the database but not in the dump: {ids_in_db[0:5].tolist()}...'
     )
 
     if delete:
-        # Delete all notes that are currently in the database but not in the dump
-        result = collection.delete_many(
-            {'_id': {'$in': list(ids_in_db)}}, hint='_id_'
-        )
+        # Delete all notes that are currently in the database but not in the dump (in chunks to limit the size of each command)
+        deleted_count = 0
+        for start in range(0, len(ids_in_db), chunk_size):
+            chunk = ids_in_db[start : start + chunk_size].tolist()
+            # The tiles containing the deleted notes need to be rendered again
+            tiles.mark(
+                client.notesreview,
+                [
+                    note['coordinates']
+                    for note in collection.find(
+                        {'_id': {'$in': chunk}}, {'coordinates': True}
+                    )
+                ],
+            )
+            result = collection.delete_many(
+                {'_id': {'$in': chunk}}, hint='_id_'
+            )
+            deleted_count += result.deleted_count
         tqdm.write(
-            f'Deleted {result.deleted_count} notes which are not present in the notes dump anymore'
+            f'Deleted {deleted_count} notes which are not present in the notes dump anymore'
         )
+        if deleted_count > 0:
+            tiles.render(client.notesreview)
+            status.bump(client.notesreview)
         # Use the creation date of the last note in the dump as the timestamp of the last synchronization
         last_note = collection.find_one({'_id': last_id})
         last_date = last_note['comments'][0]['date']
@@ -89,6 +133,17 @@ parser.add_argument(
     action='store_true',
     help='confirm deletion of the notes',
 )
+parser.add_argument(
+    '-c',
+    '--chunk-size',
+    type=int,
+    default=10000,
+    help='set the number of notes deleted at once (default: 10000)',
+)
 args = parser.parse_args()
 
-delete(*ids(args.file), args.delete)
+ids_in_dump, last_id = ids(args.file)
+# Comparing an empty dump with the database would delete all notes
+if last_id is None:
+    parser.error(f'the notes dump {args.file} does not contain any notes')
+delete(ids_in_dump, last_id, args.delete, args.chunk_size)
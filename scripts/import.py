@@ -1,11 +1,18 @@
 import argparse
+import concurrent.futures
 import datetime
+import hashlib
+import io
+import multiprocessing
 import os
 import queue
 import textwrap
 import threading
 
+import derived
 import iteration
+import status
+import tiles
 from dotenv import load_dotenv
 from lxml import etree
 from pymongo import MongoClient, UpdateOne
@@ -23,17 +30,99 @@ DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 
 
 # Parses an XML file containing all notes and inserts them into the database
-def insert(file: str) -> None:
-    # Notes are inserted/updated in batches of 50000
-    BATCH_SIZE = 50000
+def insert(
+    file: str,
+    processes: int,
+    writers: int,
+    batch_size: int,
+    queue_size: int,
+    chunk_size: int,
+    incremental: bool,
+) -> None:
+    if processes == 1:
+        all_stats, last_id = load(
+            file, writers, batch_size, queue_size, incremental
+        )
+    else:
+        # 0. Deleted 1. Added, 2. Updated, 3. Matched, 4. Skipped
+        all_stats = [0, 0, 0, 0, 0]
+        last_id = 0
+
+        # Split the file into parts which are parsed and written by separate processes
+        # (which are spawned instead of forked, to not share the database client)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    load_chunk,
+                    file,
+                    start,
+                    end,
+                    writers,
+                    batch_size,
+                    queue_size,
+                    incremental,
+                )
+                for start, end in split(file, chunk_size)
+            ]
+            for future in tqdm(
+                concurrent.futures.as_completed(futures), total=len(futures)
+            ):
+                stats, chunk_last_id = future.result()
+                all_stats = [sum(x) for x in zip(all_stats, stats)]
+                last_id = max(last_id, chunk_last_id)
+
+    # All tiles are rendered again after a full import, since most notes were written
+    if incremental:
+        tiles.render(client.notesreview)
+    else:
+        tiles.rebuild(client.notesreview)
+    # The version is only changed once the notes of the tiles are counted again,
+    # so that the API does not cache clusters with outdated counts
+    status.bump(client.notesreview)
+
+    # Use the creation date of the last note in the dump as the timestamp of the last import
+    last_date = collection.find_one({'_id': last_id})['comments'][0]['date']
+    with open(os.path.join(DIRECTORY, 'LAST_IMPORT.txt'), 'w') as file:
+        file.write(last_date.isoformat(timespec='seconds'))
 
+    tqdm.write(
+        textwrap.dedent(
+            f"""
+            ----------------------------------------
+            IMPORT SUMMARY
+            --------------------
+            Deleted {all_stats[0]} notes
+            Added {all_stats[1]} new notes
+            Updated {all_stats[2]} already existing notes
+            Matched {all_stats[3]} notes
+            Skipped {all_stats[4]} unchanged notes
+            ----------------------------------------
+            Please make sure to run the update script at least until {last_date.isoformat(timespec='seconds')}
+            to import all changes between the creation of the notes dump and now.
+            """
+        )
+    )
+
+
+# Parses notes from a file (or file-like object) and writes them to the database in batches
+def load(
+    source: str | io.BytesIO,
+    writers: int,
+    batch_size: int,
+    queue_size: int,
+    incremental: bool,
+    progress: bool = True,
+) -> tuple[list[int], int]:
     operations = []
-    # 0. Deleted 1. Added, 2. Updated, 3. Matched
-    all_stats = [0, 0, 0, 0]
+    # 0. Deleted 1. Added, 2. Updated, 3. Matched, 4. Skipped
+    all_stats = [0, 0, 0, 0, 0]
     last_id = 0
 
-    # The writer thread consumes batches from the queue and writes them to the database
-    write_queue = queue.Queue(maxsize=4)
+    # The writer threads consume batches from the queue and write them to the database
+    write_queue = queue.Queue(maxsize=queue_size)
     stats_lock = threading.Lock()
 
     def writer() -> None:
@@ -42,12 +131,15 @@ def insert(file: str) -> None:
             batch = write_queue.get()
             if batch is None:
                 break
-            stats = write(batch)
+            stats = write(batch, incremental)
             with stats_lock:
                 all_stats = [sum(x) for x in zip(all_stats, stats)]
 
-    writer_thread = threading.Thread(target=writer, daemon=True)
-    writer_thread.start()
+    writer_threads = [
+        threading.Thread(target=writer, daemon=True) for _ in range(writers)
+    ]
+    for writer_thread in writer_threads:
+        writer_thread.start()
 
     def process_element(element: etree.Element) -> None:
         nonlocal operations, all_stats, last_id
@@ -57,6 +149,7 @@ def insert(file: str) -> None:
             id = int(attributes['id'])
             last_id = id
             comments = parse(element)
+            fields = derived.fields(comments)
             note = {
                 '_id': id,
                 'coordinates': [
@@ -66,70 +159,154 @@ def insert(file: str) -> None:
                 'status': 'closed' if 'closed_at' in attributes else 'open',
                 'updated_at': comments[-1]['date'],
                 'comments': comments,
+                **fields,
+                'fingerprint': fingerprint(attributes, comments),
             }
         except Exception:
             tqdm.write(f'Failed to parse note with the id {id}')
             return
 
         operations.append(
-            UpdateOne(
-                {'_id': id},
-                {
-                    '$set': {
-                        'status': note['status'],
-                        'updated_at': note['updated_at'],
-                        'comments': note['comments'],
+            (
+                id,
+                note['fingerprint'],
+                note['coordinates'],
+                UpdateOne(
+                    {'_id': id},
+                    {
+                        '$set': {
+                            'status': note['status'],
+                            'updated_at': note['updated_at'],
+                            'comments': note['comments'],
+                            **fields,
+                            'fingerprint': note['fingerprint'],
+                        },
+                        '$setOnInsert': {
+                            'coordinates': note['coordinates'],
+                        },
                     },
-                    '$setOnInsert': {
-                        'coordinates': note['coordinates'],
-                    },
-                },
-                upsert=True,
-                hint='_id_',
+                    upsert=True,
+                    hint='_id_',
+                ),
             )
         )
 
-        if len(operations) >= BATCH_SIZE:
+        if len(operations) >= batch_size:
             write_queue.put(operations)
             operations = []
 
     iteration.fast_iter(
-        tqdm(etree.iterparse(file, tag='note', events=('end',))),
+        tqdm(
+            etree.iterparse(source, tag='note', events=('end',)),
+            disable=not progress,
+        ),
         process_element,
     )
 
     if len(operations) > 0:
         write_queue.put(operations)
 
-    # Signal the writer thread to stop
-    write_queue.put(None)
-    writer_thread.join()
+    # Signal the writer threads to stop
+    for _ in writer_threads:
+        write_queue.put(None)
+    for writer_thread in writer_threads:
+        writer_thread.join()
 
-    # Use the creation date of the last note in the dump as the timestamp of the last import
-    last_date = collection.find_one({'_id': last_id})['comments'][0]['date']
-    with open(os.path.join(DIRECTORY, 'LAST_IMPORT.txt'), 'w') as file:
-        file.write(last_date.isoformat(timespec='seconds'))
+    return all_stats, last_id
 
-    tqdm.write(
-        textwrap.dedent(
-            f"""
-            ----------------------------------------
-            IMPORT SUMMARY
-            --------------------
-            Deleted {all_stats[0]} notes
-            Added {all_stats[1]} new notes
-            Updated {all_stats[2]} already existing notes
-            Matched {all_stats[3]} notes
-            ----------------------------------------
-            Please make sure to run the update script at least until {last_date.isoformat(timespec='seconds')}
-            to import all changes between the creation of the notes dump and now.
-            """
-        )
+
+# Parses and writes the notes contained in the given range of bytes of the file
+def load_chunk(
+    file: str,
+    start: int,
+    end: int,
+    writers: int,
+    batch_size: int,
+    queue_size: int,
+    incremental: bool,
+) -> tuple[list[int], int]:
+    with open(file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Wrap the notes in a root element again to get a well-formed document
+    source = io.BytesIO(b'<osm-notes>' + data + b'</osm-notes>')
+    return load(
+        source, writers, batch_size, queue_size, incremental, progress=False
     )
 
 
-# Write operations to the database using the bulk write feature
-def write(operations: list[UpdateOne]) -> list[int]:
+# Splits the file into ranges of bytes of roughly the given size,
+# which always start at the beginning of a note and end before the next one
+def split(file: str, size: int) -> list[tuple[int, int]]:
+    NOTE = b'<note '
+    ROOT = b'</osm-notes>'
+
+    def find(f: io.BufferedReader, position: int, needle: bytes) -> int:
+        f.seek(position)
+        # Position of the beginning of the buffer in the file
+        offset = position
+        buffer = b''
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                return -1
+            buffer += data
+            index = buffer.find(needle)
+            if index != -1:
+                return offset + index
+            # Keep the end of the buffer, because the needle might be split between two reads
+            keep = len(needle) - 1
+            offset += len(buffer) - keep
+            buffer = buffer[-keep:]
+
+    with open(file, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        first = find(f, 0, NOTE)
+        if first == -1:
+            return []
+        last = find(f, max(first, total - 1024 * 1024), ROOT)
+        if last == -1:
+            last = total
+
+        boundaries = [first]
+        while boundaries[-1] + size < last:
+            boundary = find(f, boundaries[-1] + size, NOTE)
+            if boundary == -1 or boundary >= last:
+                break
+            boundaries.append(boundary)
+        boundaries.append(last)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+# Write operations to the database using the bulk write feature,
+# but skip all notes that did not change since they were imported the last time
+def write(
+    batch: list[tuple[int, int, list[float], UpdateOne]], incremental: bool
+) -> list[int]:
+    operations = [operation for _, _, _, operation in batch]
+    if incremental:
+        fingerprints = {
+            document['_id']: document.get('fingerprint')
+            for document in collection.find(
+                {'_id': {'$in': [id for id, _, _, _ in batch]}},
+                {'fingerprint': True},
+            )
+        }
+        changed = [
+            (coordinates, operation)
+            for id, fingerprint, coordinates, operation in batch
+            if fingerprints.get(id) != fingerprint
+        ]
+        operations = [operation for _, operation in changed]
+        # Only the tiles containing changed notes need to be rendered again
+        tiles.mark(
+            client.notesreview, [coordinates for coordinates, _ in changed]
+        )
+    skipped = len(batch) - len(operations)
+    if len(operations) == 0:
+        return [0, 0, 0, 0, skipped]
+
     result = collection.bulk_write(operations, ordered=False)
     if result.bulk_api_result['writeErrors']:
         client.events.errors.insert_one(
@@ -144,9 +321,31 @@ def write(operations: list[UpdateOne]) -> list[int]:
         result.bulk_api_result['nInserted'],
         result.bulk_api_result['nModified'],
         result.bulk_api_result['nMatched'],
+        skipped,
     ]
 
 
+# Compute a compact fingerprint of the content of a note to detect changes between two imports
+def fingerprint(attributes: dict, comments: list[dict]) -> int:
+    content = hashlib.blake2b(digest_size=8)
+    content.update(('closed_at' in attributes).to_bytes())
+    for comment in comments:
+        content.update(
+            '\x1f'.join(
+                [
+                    comment['date'].isoformat(),
+                    comment['action'],
+                    str(comment.get('uid', '')),
+                    comment.get('user', ''),
+                    comment.get('text', ''),
+                    '\x1e',
+                ]
+            ).encode()
+        )
+    # Use a signed integer to be able to store it as a 64-bit integer
+    return int.from_bytes(content.digest(), signed=True)
+
+
 # Parse the comments and extract only the useful information
 def parse(note: etree.Element) -> list[dict]:
     comments = []
@@ -169,10 +368,63 @@ def parse(note: etree.Element) -> list[dict]:
     return comments
 
 
-parser = argparse.ArgumentParser(description='Import notes from a notes dump.')
-parser.add_argument(
-    'file', type=str, help='path to the file which contains the notes dump'
-)
-args = parser.parse_args()
+# The entry point needs to be guarded, because the processes used for parsing import this module again
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Import notes from a notes dump.'
+    )
+    parser.add_argument(
+        'file', type=str, help='path to the file which contains the notes dump'
+    )
+    parser.add_argument(
+        '-p',
+        '--processes',
+        type=int,
+        default=1,
+        help='set the number of processes used for parsing the notes dump (default: 1)',
+    )
+    parser.add_argument(
+        '-w',
+        '--writers',
+        type=int,
+        default=1,
+        help='set the number of concurrent writers per process (default: 1)',
+    )
+    parser.add_argument(
+        '-b',
+        '--batch-size',
+        type=int,
+        default=50000,
+        help='set the number of notes written at once (default: 50000)',
+    )
+    parser.add_argument(
+        '-q',
+        '--queue-size',
+        type=int,
+        default=4,
+        help='set the number of batches waiting to be written per process (default: 4)',
+    )
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        type=int,
+        default=64,
+        help='set the size of the parts of the notes dump parsed by each process in MB (default: 64)',
+    )
+    parser.add_argument(
+        '--full',
+        default=False,
+        action='store_true',
+        help='write all notes, even if they did not change since the last import',
+    )
+    args = parser.parse_args()
 
-insert(args.file)
+    insert(
+        args.file,
+        args.processes,
+        args.writers,
+        args.batch_size,
+        args.queue_size,
+        args.chunk_size * 1024 * 1024,
+        not args.full,
+    )
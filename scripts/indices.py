@@ -1,4 +1,5 @@
 # import json
+import argparse
 import os
 
 import pymongo
@@ -23,32 +24,213 @@ RUN_IN_BACKGROUND = False
 #     'validator': schema['notesreview.notes']
 # })
 
-# Create indices used for faster queries
-db.notes.create_index(
-    [('updated_at', pymongo.DESCENDING)],
-    name='updated_at',
-    background=RUN_IN_BACKGROUND,
-)
-db.notes.create_index(
-    [('comments.0.date', pymongo.DESCENDING)],
-    name='created_at',
-    background=RUN_IN_BACKGROUND,
-)
-db.notes.create_index(
-    [('coordinates', pymongo.GEOSPHERE)],
-    name='coordinates',
-    background=RUN_IN_BACKGROUND,
+# Indices used for faster queries, which match the conditions and the sort order of the searches
+# (the sort indices contain the id as a tiebreaker, which is required for paginating with a cursor)
+INDICES = [
+    pymongo.IndexModel(
+        [('updated_at', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        name='updated_at',
+        background=RUN_IN_BACKGROUND,
+    ),
+    pymongo.IndexModel(
+        [('created_at', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        name='created_at',
+        background=RUN_IN_BACKGROUND,
+    ),
+    # Notes with a given status, sorted by the date of their last or first comment
+    pymongo.IndexModel(
+        [
+            ('status', pymongo.ASCENDING),
+            ('updated_at', pymongo.DESCENDING),
+            ('_id', pymongo.DESCENDING),
+        ],
+        name='status_updated_at',
+        background=RUN_IN_BACKGROUND,
+    ),
+    pymongo.IndexModel(
+        [
+            ('status', pymongo.ASCENDING),
+            ('created_at', pymongo.DESCENDING),
+            ('_id', pymongo.DESCENDING),
+        ],
+        name='status_created_at',
+        background=RUN_IN_BACKGROUND,
+    ),
+    # Notes in a region, which are usually also filtered by their status
+    pymongo.IndexModel(
+        [
+            ('coordinates', pymongo.GEOSPHERE),
+            ('status', pymongo.ASCENDING),
+            ('updated_at', pymongo.DESCENDING),
+        ],
+        name='coordinates',
+        background=RUN_IN_BACKGROUND,
+    ),
+    pymongo.IndexModel(
+        [
+            ('comments.0.user', pymongo.ASCENDING),
+            ('created_at', pymongo.DESCENDING),
+            ('_id', pymongo.DESCENDING),
+        ],
+        name='author',
+        background=RUN_IN_BACKGROUND,
+    ),
+    # Notes with a given amount of comments (e.g. uncommented notes), which are derived from the comments
+    pymongo.IndexModel(
+        [
+            ('comment_count', pymongo.ASCENDING),
+            ('status', pymongo.ASCENDING),
+            ('updated_at', pymongo.DESCENDING),
+            ('_id', pymongo.DESCENDING),
+        ],
+        name='comment_count',
+        background=RUN_IN_BACKGROUND,
+    ),
+    pymongo.IndexModel(
+        [
+            ('comments.user', pymongo.ASCENDING),
+            ('updated_at', pymongo.DESCENDING),
+            ('_id', pymongo.DESCENDING),
+        ],
+        name='user',
+        background=RUN_IN_BACKGROUND,
+    ),
+    pymongo.IndexModel(
+        [('comments.text', pymongo.TEXT)],
+        default_language='none',
+        name='text',
+        background=RUN_IN_BACKGROUND,
+    ),
+]
+
+# Smaller indices which only contain open notes (optional, since they are only used for searches of open notes)
+PARTIAL_INDICES = [
+    pymongo.IndexModel(
+        [('updated_at', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        name='open_updated_at',
+        partialFilterExpression={'status': 'open'},
+        background=RUN_IN_BACKGROUND,
+    ),
+    pymongo.IndexModel(
+        [('created_at', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        name='open_created_at',
+        partialFilterExpression={'status': 'open'},
+        background=RUN_IN_BACKGROUND,
+    ),
+]
+
+# Maximum size (in bytes) of the collection of changes, which only needs to contain the recent changes
+CHANGES_SIZE = 64 * 1024 * 1024
+
+# Options which are part of the definition of an index
+OPTIONS = ['partialFilterExpression', 'default_language', 'unique', 'sparse']
+
+
+# The definition of an index, which can be compared with the information returned by the database
+def definition(index: dict) -> dict:
+    key = index['key']
+    key = list(key.items()) if isinstance(key, dict) else key
+    # The database only returns the fields of text indices as their weights
+    if '_fts' in dict(key):
+        key = sorted(index['weights'].items())
+    elif any(direction == pymongo.TEXT for _, direction in key):
+        key = sorted(
+            (field, 1) for field, direction in key if direction == pymongo.TEXT
+        )
+
+    return {
+        'key': list(key),
+        **{option: index[option] for option in OPTIONS if option in index},
+    }
+
+
+# Compare the indices of the database with the required ones
+def diff(
+    indices: list[pymongo.IndexModel],
+) -> tuple[list[pymongo.IndexModel], list[pymongo.IndexModel], list[str]]:
+    existing = db.notes.index_information()
+    missing = []
+    changed = []
+    for index in indices:
+        name = index.document['name']
+        if name not in existing:
+            missing.append(index)
+        elif definition(index.document) != definition(existing[name]):
+            changed.append(index)
+
+    names = {index.document['name'] for index in indices}
+    obsolete = [
+        name for name in existing if name not in names and name != '_id_'
+    ]
+    return missing, changed, obsolete
+
+
+# The number of times each index was used since the database server was started
+def usage() -> dict[str, int]:
+    return {
+        stats['name']: stats['accesses']['ops']
+        for stats in db.notes.aggregate([{'$indexStats': {}}])
+    }
+
+
+def report(
+    missing: list[pymongo.IndexModel],
+    changed: list[pymongo.IndexModel],
+    obsolete: list[str],
+) -> None:
+    for index in missing:
+        print(f'Missing: {index.document["name"]}')
+    for index in changed:
+        print(f'Changed: {index.document["name"]}')
+    for name in obsolete:
+        print(f'Obsolete: {name}')
+
+    for name, ops in usage().items():
+        if ops == 0 and name != '_id_':
+            print(f'Unused: {name}')
+
+
+parser = argparse.ArgumentParser(
+    description='Create the indices used for faster queries.'
 )
-db.notes.create_index('status', name='status', background=RUN_IN_BACKGROUND)
-db.notes.create_index(
-    'comments.0.user', name='author', background=RUN_IN_BACKGROUND
+parser.add_argument(
+    '--partial',
+    default=False,
+    action='store_true',
+    help='also create the partial indices which only contain open notes',
 )
-db.notes.create_index(
-    'comments.user', name='user', background=RUN_IN_BACKGROUND
+parser.add_argument(
+    '--dry-run',
+    default=False,
+    action='store_true',
+    help='only report missing, changed, obsolete and unused indices',
 )
-db.notes.create_index(
-    [('comments.text', pymongo.TEXT)],
-    default_language='none',
-    name='text',
-    background=RUN_IN_BACKGROUND,
+parser.add_argument(
+    '--drop',
+    default=False,
+    action='store_true',
+    help='drop obsolete indices which are not required anymore',
 )
+args = parser.parse_args()
+
+indices = INDICES + PARTIAL_INDICES if args.partial else INDICES
+missing, changed, obsolete = diff(indices)
+report(missing, changed, obsolete)
+
+if not args.dry_run:
+    # Indices whose definition changed need to be dropped before they can be created again
+    for index in changed:
+        db.notes.drop_index(index.document['name'])
+    if len(missing + changed) > 0:
+        db.notes.create_indexes(missing + changed)
+    if args.drop:
+        for name in obsolete:
+            db.notes.drop_index(name)
+
+    # The live feed of the API reads the changes written by the update script
+    # from a capped collection if the database does not support change streams
+    try:
+        db.notes.watch().close()
+    except pymongo.errors.OperationFailure:
+        if 'changes' not in db.list_collection_names():
+            db.create_collection('changes', capped=True, size=CHANGES_SIZE)
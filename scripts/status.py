@@ -0,0 +1,22 @@
+from pymongo.database import Database
+
+
+# Increment the version of the notes after they were changed,
+# which is used by the API to invalidate cached search results
+def bump(db: Database) -> None:
+    db.status.update_one(
+        {'_id': 'notes'},
+        {
+            '$inc': {'version': 1},
+            '$currentDate': {'updated_at': True},
+        },
+        upsert=True,
+    )
+
+
+# Write the changed notes to the capped collection of changes, which is read by the API
+# to forward them to the clients of the live feed if the database does not support change streams
+# (the collection is only created by indices.py in this case)
+def publish(db: Database, notes: list[dict]) -> None:
+    if len(notes) > 0 and db.changes.options().get('capped', False):
+        db.changes.insert_many([{'note': note} for note in notes])
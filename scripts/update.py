@@ -1,4 +1,5 @@
 import argparse
+import concurrent.futures
 import datetime
 import math
 import os
@@ -6,7 +7,10 @@ import textwrap
 import urllib.parse
 
 import dateutil.parser
+import derived
 import requests
+import status
+import tiles
 from dotenv import load_dotenv
 from pymongo import DeleteOne, InsertOne, MongoClient, UpdateOne
 
@@ -18,6 +22,16 @@ client = MongoClient(
 )
 collection = client.notesreview.notes
 
+# Reuse the connections to the OSM Notes API for all requests
+session = requests.Session()
+session.headers.update(
+    {
+        # Add a valid user agent to prevent the request from being blocked by the OSM API,
+        # see also https://operations.osmfoundation.org/policies/api/
+        'User-Agent': 'notesreview-api'
+    }
+)
+
 DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -41,6 +55,13 @@ def update(limit: int = 100) -> None:
     all_stats = [0, 0, 0, 0]
     all_ignored = False
 
+    # Operations are written in a separate thread while the next page is already fetched,
+    # the notes of the page that is possibly still being written are kept
+    # to compare them with the notes of the next page instead of the database
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending = None
+    previous = {}
+
     # Either stop in case the stop date (i.e. the date of the last update) is exceeded or all notes are being ignored when inserting
     while (
         upper_bound is not None
@@ -55,19 +76,21 @@ def update(limit: int = 100) -> None:
             }
         )
         print(f'Fetching notes updated before {upper_bound} ({url})')
-        response = requests.get(
-            url,
-            headers={
-                # Add a valid user agent to prevent the request from being blocked by the OSM API,
-                # see also https://operations.osmfoundation.org/policies/api/
-                'User-Agent': 'notesreview-api'
-            },
-        )
+        response = session.get(url)
         response = response.json()
         features = response['features']
 
-        stats, oldest = insert(features)
+        operations, stats, oldest, notes, changed = insert(features, previous)
         all_stats = [sum(x) for x in zip(all_stats, stats)]
+        tiles.mark(
+            client.notesreview, [note['coordinates'] for note in changed]
+        )
+
+        # Wait for the previous page to be written before writing the next one
+        if pending is not None:
+            pending.result()
+        pending = executor.submit(write, operations, changed)
+        previous = notes
 
         # Check whether all features were ignored, meaning there are no updates anymore
         all_ignored = stats[3] == len(features)
@@ -75,6 +98,10 @@ def update(limit: int = 100) -> None:
 
         print(f'Determined the oldest note update to be {oldest}')
 
+    if pending is not None:
+        pending.result()
+    executor.shutdown()
+
     print(
         textwrap.dedent(
             f"""
@@ -95,6 +122,10 @@ def update(limit: int = 100) -> None:
         )
     )
 
+    if all_stats[0] + all_stats[1] + all_stats[2] > 0:
+        tiles.render(client.notesreview)
+        status.bump(client.notesreview)
+
     with open(os.path.join(DIRECTORY, 'LAST_UPDATE.txt'), 'w') as file:
         file.write(update_start_time.isoformat(timespec='seconds'))
     # ---------------------------------------- #
@@ -128,11 +159,47 @@ def parse(comments: list[dict]) -> list[dict]:
     return comments
 
 
+# Find all notes of a page which are already stored in the database at once,
+# but use the notes of the previous page instead if they might not be written yet
+def lookup(
+    ids: list[int], previous: dict[int, dict | None]
+) -> dict[int, dict]:
+    documents = {
+        document['_id']: document
+        for document in collection.find(
+            {'_id': {'$in': ids}},
+            # Only the fields that are compared with the notes from the API
+            {
+                'coordinates': True,
+                'status': True,
+                'updated_at': True,
+                'comments': True,
+            },
+        )
+    }
+    for id in ids:
+        if id in previous:
+            note = previous[id]
+            if note is None:
+                documents.pop(id, None)
+            else:
+                documents[id] = note
+    return documents
+
+
 # Loops through the provided list of notes and:
 # - Adds notes if they are unknown
 # - Updates notes if there is a different version
 # - Ignores notes which are the same
-def insert(features: list[dict]) -> tuple[list[int], datetime.datetime | None]:
+def insert(
+    features: list[dict], previous: dict[int, dict | None]
+) -> tuple[
+    list[DeleteOne | InsertOne | UpdateOne],
+    list[int],
+    datetime.datetime | None,
+    dict[int, dict | None],
+    list[dict],
+]:
     operations = []
     deleted = 0
     inserted = 0
@@ -140,6 +207,15 @@ def insert(features: list[dict]) -> tuple[list[int], datetime.datetime | None]:
     ignored = 0
     oldest = None
 
+    documents = lookup(
+        [feature['properties']['id'] for feature in features], previous
+    )
+    # The state of all notes of this page after the operations are written
+    notes = {}
+    # All notes that are changed, which are used to render the tiles containing them again
+    # and are published to the live feed (including the fields derived from the comments)
+    changed = []
+
     for feature in features:
         comments = parse(feature['properties']['comments'])
         note = {
@@ -159,14 +235,18 @@ def insert(features: list[dict]) -> tuple[list[int], datetime.datetime | None]:
             # especially as the comments might have been removed by a moderator
             # and should not be visible to the public
             operations.append(DeleteOne(query))
+            notes[note['_id']] = None
+            changed.append(note)
             deleted += 1
             continue
 
         # Check whether the note is already in the database and proceed with different operations
-        document = collection.find_one(query)
+        document = documents.get(note['_id'])
+        notes[note['_id']] = note
         if document is None:
             # Note is not yet in the database, insert it
-            operations.append(InsertOne(note))
+            changed.append({**note, **derived.fields(note['comments'])})
+            operations.append(InsertOne(changed[-1]))
             inserted += 1
         elif note == document:
             # Note is already stored in the database, the statement is only true if
@@ -184,10 +264,15 @@ def insert(features: list[dict]) -> tuple[list[int], datetime.datetime | None]:
                             'status': note['status'],
                             'updated_at': note['updated_at'],
                             'comments': note['comments'],
-                        }
+                            **derived.fields(note['comments']),
+                        },
+                        # The fingerprint is computed from the notes dump, whose content might differ
+                        # from the API, so the next import needs to compare the note again
+                        '$unset': {'fingerprint': True},
                     },
                 )
             )
+            changed.append({**note, **derived.fields(note['comments'])})
             updated += 1
 
         # Check whether this note is the one with the oldest update date (for the upper bound of the next request)
@@ -214,17 +299,38 @@ def insert(features: list[dict]) -> tuple[list[int], datetime.datetime | None]:
         ) and (oldest is None or last_changed < oldest):
             oldest = last_changed
 
-    if len(operations) != 0:
-        result = collection.bulk_write(operations, ordered=False)
-        if result.bulk_api_result['writeErrors']:
-            client.events.errors.insert_one(
-                {
-                    'type': 'update_error',
-                    'timestamp': datetime.datetime.now(datetime.timezone.utc),
-                    'error': result.bulk_api_result['writeErrors'],
-                }
-            )
-    return [deleted, inserted, updated, ignored], oldest
+    return (
+        operations,
+        [deleted, inserted, updated, ignored],
+        oldest,
+        notes,
+        changed,
+    )
+
+
+# Write operations to the database using the bulk write feature
+# and publish the changed notes afterwards
+def write(
+    operations: list[DeleteOne | InsertOne | UpdateOne], changed: list[dict]
+) -> None:
+    if len(operations) == 0:
+        return
+
+    result = collection.bulk_write(operations, ordered=False)
+    if result.bulk_api_result['writeErrors']:
+        client.events.errors.insert_one(
+            {
+                'type': 'update_error',
+                'timestamp': datetime.datetime.now(datetime.timezone.utc),
+                'error': result.bulk_api_result['writeErrors'],
+            }
+        )
+
+    # Deleted notes are not published, since they do not match any filter
+    status.publish(
+        client.notesreview,
+        [note for note in changed if len(note['comments']) > 0],
+    )
 
 
 parser = argparse.ArgumentParser(
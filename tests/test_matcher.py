@@ -0,0 +1,332 @@
+import datetime
+import os
+import random
+import sys
+from collections.abc import Iterator
+from typing import Any
+
+import orjson
+import pytest
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from api.matcher import predicate
+from api.query import Filter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+import derived  # noqa: E402
+
+# The conformance tests compare the matcher with the database, so they are skipped
+# if there is no database which can be used (unless its URI is given explicitly, e.g. in CI)
+URI = os.environ.get('TEST_MONGODB_URI', 'mongodb://127.0.0.1:27017')
+START = datetime.datetime(2020, 1, 1)
+USERS = [
+    (1, 'Mapper'),
+    (2, 'mapper'),
+    (3, 'Some Mapper'),
+    (4, 'mäpper_4'),
+    (5, 'NOT Mapper'),
+]
+# Words in different cases, with diacritics, punctuation and underscores
+WORDS = (
+    'road Road ROAD bridge café Cafe CAFÉ straße strasse über uber '
+    'missing,name foo_bar bar. (closed) shop-name 12 numéro'
+).split()
+SORT = ('updated_at', -1)
+
+
+@pytest.fixture(scope='module')
+def collection() -> Iterator[Collection]:
+    client = MongoClient(URI, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except PyMongoError:
+        if 'TEST_MONGODB_URI' in os.environ:
+            raise
+        pytest.skip(f'There is no database available at {URI}')
+
+    collection = client.notesreview_test.notes
+    collection.drop()
+    # The same text index as in scripts/indices.py
+    collection.create_index(
+        [('comments.text', 'text')], default_language='none'
+    )
+    collection.insert_many(notes(300))
+    yield collection
+    collection.drop()
+    client.close()
+
+
+# Create random (but reproducible) notes in the same format as the imported ones
+def notes(amount: int) -> list[dict]:
+    generator = random.Random(0)
+    result = []
+    for id in range(1, amount + 1):
+        date = START + datetime.timedelta(hours=generator.randrange(10000))
+        comments = []
+        for i in range(generator.choice([1, 1, 2, 3, 5])):
+            comment: dict[str, Any] = {
+                'date': date + datetime.timedelta(days=i),
+                'action': 'opened' if i == 0 else 'commented',
+            }
+            if i > 0 or generator.random() > 0.3:
+                comment['uid'], comment['user'] = generator.choice(USERS)
+            if generator.random() > 0.1:
+                comment['text'] = ' '.join(
+                    generator.choices(WORDS, k=generator.randint(1, 6))
+                )
+            comments.append(comment)
+        if len(comments) > 1 and generator.random() > 0.5:
+            comments[-1]['action'] = 'closed'
+
+        result.append(
+            {
+                '_id': id,
+                # Positions are never close to the edges of the polygons below,
+                # where geodesics and straight lines differ
+                'coordinates': [
+                    generator.randrange(-50, 50) / 10 + 0.05,
+                    generator.randrange(-50, 50) / 10 + 0.05,
+                ],
+                'status': 'closed'
+                if comments[-1]['action'] == 'closed'
+                else 'open',
+                'updated_at': comments[-1]['date'],
+                'comments': comments,
+                **derived.fields(comments),
+            }
+        )
+    return result
+
+
+def square(x1: int, y1: int, x2: int, y2: int) -> list[list[int]]:
+    return [[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]
+
+
+POLYGON = {'type': 'Polygon', 'coordinates': [square(-3, -3, 3, 3)]}
+HOLE = {
+    'type': 'Polygon',
+    'coordinates': [square(-4, -4, 4, 4), square(-1, -1, 2, 2)],
+}
+MULTIPOLYGON = {
+    'type': 'MultiPolygon',
+    'coordinates': [[square(-5, -5, -2, -2)], [square(1, 0, 4, 3)]],
+}
+
+# Parameters of the filters in the same format as the ones of a search
+CASES: list[dict[str, Any]] = [
+    {},
+    {'status': 'open'},
+    {'status': 'closed'},
+    {'bbox': '-2,-3,1.5,4'},
+    {'polygon': POLYGON},
+    {'polygon': HOLE},
+    {'polygon': MULTIPOLYGON},
+    {'query': 'road'},
+    {'query': 'cafe'},
+    {'query': 'CAFÉ bridge'},
+    {'query': 'strasse'},
+    {'query': 'straße'},
+    {'query': 'uber'},
+    {'query': 'foo'},
+    {'query': 'foo_bar'},
+    {'query': 'name'},
+    {'query': '12'},
+    {'query': 'road -bridge'},
+    {'query': 'road -cafe'},
+    {'query': '"road bridge"'},
+    {'query': '"café road"'},
+    {'query': '"missing,name"'},
+    {'query': '"road" "bridge" -shop'},
+    {'query': 'road', 'scope': 'first'},
+    {'query': 'café bridge', 'scope': 'first'},
+    {'query': '"road bridge"', 'scope': 'first'},
+    {'query': 'road -bridge', 'scope': 'first'},
+    {'query': 'regex:^road'},
+    {'query': 'regex:caf[eé]$', 'scope': 'first'},
+    {'query': 'regex:\\(closed\\)'},
+    {'author': 'Mapper'},
+    {'author': 'Some Mapper, mäpper_4'},
+    {'author': 'NOT Mapper'},
+    {'user': 'mapper'},
+    {'user': 'Mapper, Some Mapper'},
+    {'user': 'Mapper, NOT mapper'},
+    {'user': 'NOT Some Mapper'},
+    {'after': '2020-06-01'},
+    {'before': '2020-06-01T12:00:00Z'},
+    {'after': '2020-03-01', 'before': '2020-09-01'},
+    {'comments': '0'},
+    {'comments': '2'},
+    {'comments': '1-3'},
+    {'comments': '2-'},
+    {'comments': '-1'},
+    {'commented': 'hide'},
+    {'commented': 'only'},
+    {'anonymous': 'hide'},
+    {'anonymous': 'only'},
+    {'exclude': list(range(1, 300, 3))},
+    {'watchlist': ('hide', list(range(1, 300, 5)))},
+    {'watchlist': ('only', list(range(1, 300, 5)))},
+    {'exclude': [1, 2, 3], 'watchlist': ('hide', [4, 5, 6])},
+    {'status': 'open', 'bbox': '-5,-5,0,0', 'query': 'road'},
+    {'polygon': HOLE, 'user': 'Mapper', 'commented': 'only'},
+    {'query': 'cafe', 'scope': 'first', 'anonymous': 'hide', 'comments': '1-'},
+    {'author': 'NOT Mapper', 'status': 'closed', 'after': '2020-04-01'},
+]
+
+
+# Build the filter with the same methods as a search
+def build(args: dict[str, Any]) -> dict[str, Any]:
+    mode, watchlist = args.get('watchlist', ('include', None))
+    polygon = args.get('polygon')
+    return (
+        Filter(SORT)
+        .query(args.get('query'), args.get('scope'))
+        .bbox(args.get('bbox'))
+        .polygon(None if polygon is None else orjson.dumps(polygon).decode())
+        .status(args.get('status'))
+        .anonymous(args.get('anonymous'))
+        .author(args.get('author'))
+        .user(args.get('user'))
+        .after(args.get('after'))
+        .before(args.get('before'))
+        .comments(args.get('comments'))
+        .commented(args.get('commented'))
+        .exclude(args.get('exclude'))
+        .watchlist(
+            mode, None if watchlist is None else dict.fromkeys(watchlist, {})
+        )
+        .build()
+    )
+
+
+@pytest.mark.parametrize(
+    'args', CASES, ids=lambda args: orjson.dumps(args).decode()
+)
+def test_matcher(collection: Collection, args: dict[str, Any]) -> None:
+    filter = build(args)
+    expected = {note['_id'] for note in collection.find(filter, {'_id': 1})}
+    test = predicate(filter)
+    # The notes are read from the database to compare them with the same (rounded) values
+    actual = {note['_id'] for note in collection.find() if test(note)}
+    assert actual == expected
+
+
+def note(
+    coordinates: list[float] = [0.5, 0.5], texts: list[str] = []
+) -> dict[str, Any]:
+    return {
+        '_id': 1,
+        'coordinates': coordinates,
+        'comments': [{'text': text} for text in texts],
+    }
+
+
+# Cases which do not need a database, with the expected results of the database
+EXAMPLES: list[tuple[dict[str, Any], dict[str, Any], bool]] = [
+    # Bounding boxes ($box) contain their edges
+    ({'bbox': '0,0,1,1'}, note([0.5, 0.5]), True),
+    ({'bbox': '0,0,1,1'}, note([1, 0]), True),
+    ({'bbox': '0,0,1,1'}, note([1.5, 0.5]), False),
+    ({'bbox': '0,0,1,1'}, note([0.5, -0.1]), False),
+    ({'bbox': '-10,-5,10,5'}, note([-9.9, 4.9]), True),
+    # Polygons with holes and multipolygons
+    ({'polygon': POLYGON}, note([2.5, -2.5]), True),
+    ({'polygon': POLYGON}, note([3.5, 0]), False),
+    ({'polygon': HOLE}, note([3.5, 3.5]), True),
+    ({'polygon': HOLE}, note([0.5, 0.5]), False),
+    ({'polygon': HOLE}, note([-1.5, 0.5]), True),
+    ({'polygon': MULTIPOLYGON}, note([-3, -3]), True),
+    ({'polygon': MULTIPOLYGON}, note([2, 2]), True),
+    ({'polygon': MULTIPOLYGON}, note([0, 0]), False),
+    ({'polygon': MULTIPOLYGON}, note([2, -1]), False),
+    # Regular expressions are case insensitive and can match any comment
+    (
+        {'query': 'regex:^road', 'scope': 'all'},
+        note(texts=['Road closed']),
+        True,
+    ),
+    ({'query': 'regex:^road', 'scope': 'all'}, note(texts=['a road']), False),
+    (
+        {'query': 'regex:^road', 'scope': 'all'},
+        note(texts=['a road', 'road']),
+        True,
+    ),
+    (
+        {'query': 'regex:^road', 'scope': 'first'},
+        note(texts=['x', 'road']),
+        False,
+    ),
+    ({'query': 'regex:b.s$', 'scope': 'all'}, note(texts=['Bus']), True),
+    ({'query': 'regex:road', 'scope': 'all'}, note(), False),
+    # The text search ignores case and diacritics and splits words at punctuation and underscores
+    ({'query': 'cafe', 'scope': 'all'}, note(texts=['Café open']), True),
+    ({'query': 'CAFÉ', 'scope': 'all'}, note(texts=['cafe']), True),
+    ({'query': 'cafe', 'scope': 'all'}, note(texts=['cafeteria']), False),
+    ({'query': 'bar', 'scope': 'all'}, note(texts=['foo_bar']), True),
+    ({'query': 'foo_bar', 'scope': 'all'}, note(texts=['foo']), True),
+    ({'query': 'name', 'scope': 'all'}, note(texts=['missing,name.']), True),
+    ({'query': 'strasse', 'scope': 'all'}, note(texts=['Straße']), False),
+    ({'query': 'road bridge', 'scope': 'all'}, note(texts=['bridge']), True),
+    ({'query': 'road bridge', 'scope': 'all'}, note(texts=['tunnel']), False),
+    # Excluded words exclude the note, even if they are only contained in another comment
+    (
+        {'query': 'road -bridge', 'scope': 'all'},
+        note(texts=['road', 'bridge']),
+        False,
+    ),
+    (
+        {'query': 'road -bridge', 'scope': 'all'},
+        note(texts=['road', 'bridges']),
+        True,
+    ),
+    # Phrases need to be contained exactly (except case and diacritics), all of them are required
+    (
+        {'query': '"road bridge"', 'scope': 'all'},
+        note(texts=['Road Bridge']),
+        True,
+    ),
+    (
+        {'query': '"road bridge"', 'scope': 'all'},
+        note(texts=['bridge road']),
+        False,
+    ),
+    (
+        {'query': '"road" "bridge"', 'scope': 'all'},
+        note(texts=['road', 'bridge']),
+        True,
+    ),
+    (
+        {'query': '"road" "bridge"', 'scope': 'all'},
+        note(texts=['road']),
+        False,
+    ),
+    (
+        {'query': '"café road"', 'scope': 'all'},
+        note(texts=['CAFE ROAD']),
+        True,
+    ),
+    # Only the first comment is searched with the scope first (the default)
+    ({'query': 'road', 'scope': 'first'}, note(texts=['road', 'x']), True),
+    ({'query': 'road', 'scope': 'first'}, note(texts=['x', 'road']), False),
+    ({'query': 'road', 'scope': 'all'}, note(texts=['x', 'road']), True),
+    # The first comment is checked with a pattern, which does not ignore diacritics
+    ({'query': 'cafe', 'scope': 'first'}, note(texts=['Café']), False),
+    (
+        {'query': '"road bridge"', 'scope': 'first'},
+        note(texts=['ROAD BRIDGE']),
+        True,
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    'args, document, expected',
+    EXAMPLES,
+    ids=lambda value: orjson.dumps(value).decode(),
+)
+def test_example(
+    args: dict[str, Any], document: dict[str, Any], expected: bool
+) -> None:
+    assert predicate(build(args))(document) == expected